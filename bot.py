@@ -1,40 +1,160 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # Отсчет времени запуска до всех импортов
+
 import discord
 from discord.ext import commands, tasks
 from discord import ButtonStyle, app_commands
 from discord.ui import Button, View
-import yt_dlp as youtube_dl
+from discord.oggparse import OggStream, OggError
 import asyncio
 import logging
+import logging.handlers
 import os
 from dotenv import load_dotenv
 from collections import deque, OrderedDict
-from typing import Tuple, Optional, Dict, List, Union
+from typing import Tuple, Optional, Dict, List, Union, NamedTuple, Callable, Any
 from functools import lru_cache
-import time
+from itertools import islice
 import random
 import aiohttp
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Executor, Future
 import shutil
 import tempfile
 import os.path
 import subprocess
+import sys
+import importlib
+import threading
+import hashlib
+import bisect
+import queue
+import json
+import atexit
+import traceback
+import heapq
+import mmap
+import re
+import signal
+import itertools
 
 # Загрузка переменных окружения
 load_dotenv()
 
+class LazyModule:
+    """Откладывает импорт тяжелого модуля до первого обращения к нему"""
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# yt-dlp с сотнями экстракторов импортируется в фоне после подключения к Discord
+youtube_dl = LazyModule('yt_dlp')
+
 # Конфигурация
 COOKIES_FILE = 'cookies.txt'
+SETTINGS_FILE = os.getenv('SETTINGS_FILE', 'settings.json')  # Настройки, которые можно менять без перезапуска
+COOKIE_CHECK_INTERVAL = 30  # Как часто проверять mtime cookies.txt (секунды)
+COMMAND_HASH_FILE = '.command_tree_hash'  # Хэш последнего синхронизированного дерева команд
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC', '0') == '1'
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -timeout 10000000',
     'options': '-vn -timeout 10000000 -max_muxing_queue_size 1024'
 }
-MAX_QUEUE_SIZE = 50  # Максимальное количество треков в очереди
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 50))  # Максимальное количество треков в очереди
+QUEUE_BLOCK_SIZE = 64  # Размер блока в индексированной очереди
+
+# Повторы в очереди: политика по умолчанию, администраторы меняют ее командой /dedup
+DEDUP_MAX_COPIES = int(os.getenv('DEDUP_MAX_COPIES', 0))  # Максимум копий одного видео в очереди (0 - без ограничений)
+DEDUP_COLLAPSE_PLAYLISTS = os.getenv('DEDUP_COLLAPSE_PLAYLISTS', '0') == '1'  # Убирать повторы при импорте плейлиста
+DEDUP_POLICIES_FILE = 'dedup_policies.json'  # Политики, заданные через /dedup, по серверам
+YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})')
 
 # Добавляем константы для таймаутов
 FFMPEG_TIMEOUT = 30  # 30 секунд на инициализацию ffmpeg
 FFMPEG_KILL_TIMEOUT = 5  # 5 секунд на принудительное завершение
 MAX_RETRIES = 3  # Максимальное количество попыток
 
+# Пулы потоков по видам работы, чтобы импорт плейлиста не задерживал /play
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 10))  # Потоки извлечения yt-dlp
+EXTRACT_INTERACTIVE_RESERVE = 3  # Потоки извлечения, недоступные фоновым задачам
+if EXTRACT_WORKERS <= EXTRACT_INTERACTIVE_RESERVE:
+    raise ValueError(
+        f"EXTRACT_WORKERS ({EXTRACT_WORKERS}) должен быть больше EXTRACT_INTERACTIVE_RESERVE ({EXTRACT_INTERACTIVE_RESERVE})"
+    )
+EXTRACT_GUILD_INFLIGHT = int(os.getenv('EXTRACT_GUILD_INFLIGHT', 4))  # Одновременных извлечений на один сервер
+FAIR_QUEUE_MIN_WEIGHT = 0.01  # Меньший вес заставил бы обход крутиться под блокировкой пула
+
+def parse_guild_weights(raw: dict) -> Dict[int, float]:
+    """Веса серверов из JSON: ключи - id серверов строками"""
+    return {int(guild_id): float(weight) for guild_id, weight in raw.items()}
+
+def is_guild_weights(value: dict) -> bool:
+    try:
+        return all(weight >= FAIR_QUEUE_MIN_WEIGHT for weight in parse_guild_weights(value).values())
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+def env_guild_weights() -> dict:
+    """Веса из окружения; неверное значение не роняет импорт, о нем сообщит проверка настроек при запуске"""
+    try:
+        value = json.loads(os.getenv('EXTRACT_GUILD_WEIGHTS', '{}'))
+    except ValueError:
+        return {}
+    return value if is_guild_weights(value) else {}
+
+# Веса серверов в очереди извлечения, JSON вида {"id сервера": вес}; по умолчанию вес 1
+EXTRACT_GUILD_WEIGHTS = env_guild_weights()
+SPAWN_WORKERS = 2  # Потоки запуска процессов ffmpeg
+DISK_WORKERS = 2  # Потоки файлового ввода-вывода
+PRIORITY_INTERACTIVE = 0  # Запросы, которых ждет пользователь
+PRIORITY_BACKGROUND = 1  # Разрешение треков плейлиста и прочая фоновая работа
+WORK_POOL_WAIT_SAMPLES = 500  # Сколько последних ожиданий в очереди пула хранить для перцентилей
+
+# Нормализация громкости по заранее измеренной громкости трека
+NORMALIZE_VOLUME = os.getenv('NORMALIZE_VOLUME', '0') == '1'
+LOUDNESS_CACHE_FILE = 'loudness_cache.json'
+LOUDNESS_TARGET = -14.0  # Целевая интегральная громкость (LUFS)
+LOUDNESS_MAX_TRUE_PEAK = -1.0  # Максимальный истинный пик после усиления (dBTP)
+LOUDNESS_GAIN_LIMITS = (-20.0, 10.0)  # Границы статического усиления (дБ)
+LOUDNESS_MAX_DURATION = 900  # Не анализируем треки длиннее 15 минут
+LOUDNESS_QUEUE_SIZE = 100  # Максимум треков, ожидающих анализа
+
+MAX_PLAYLIST_SIZE = int(os.getenv('MAX_PLAYLIST_SIZE', 5000))  # Максимум треков плейлиста в очереди
+PLAYLIST_PREFETCH_WINDOW = 2  # Сколько треков плейлиста извлекать заранее
+
+# Плоское перечисление плейлиста: только id и названия, без потоков
+PLAYLIST_YDL_OPTIONS = {
+    'extract_flat': 'in_playlist',
+    'lazy_playlist': True,
+    'ignoreerrors': True,
+    'no_warnings': True,
+    'quiet': True
+}
+
+# Хеджированное извлечение: если основной клиент YouTube медлит, запускаем запасной
+PLAYER_CLIENTS = ['web', 'android', 'ios']  # Порядок по умолчанию, пока нет статистики
+HEDGE_PERCENTILE = 0.9  # Перцентиль задержки основного клиента, после которого стартует запасной
+HEDGE_DEFAULT_DELAY = 3.0  # Задержка запуска запасного запроса без статистики (секунды)
+HEDGE_MIN_DELAY = 1.0
+HEDGE_MIN_SAMPLES = 10  # Сколько замеров нужно, чтобы доверять статистике клиента
+
+YDL_SOCKET_TIMEOUT = int(os.getenv('YDL_SOCKET_TIMEOUT', 15))  # Таймаут сетевых запросов yt-dlp (секунды)
+YDL_RETRIES = int(os.getenv('YDL_RETRIES', 5))
+
 YDL_OPTIONS = {
     'format': 'bestaudio/best',
     'noplaylist': False,
@@ -43,9 +163,9 @@ YDL_OPTIONS = {
     'quiet': True,
     'extract_flat': False,
     'no_check_certificate': True,
-    'socket_timeout': 15,
-    'retries': 5,
-    'verbose': True,
+    'socket_timeout': YDL_SOCKET_TIMEOUT,
+    'retries': YDL_RETRIES,
+    'verbose': False,  # Подробный вывод yt-dlp забивает лог
     'age_limit': 21,
     'cookiefile': COOKIES_FILE,
     'http_headers': {
@@ -59,27 +179,177 @@ YDL_OPTIONS = {
             'skip': [],
             'player_skip': [],
             'skip_unavailable_videos': True,
-            'player_client': 'web',
+            'player_client': ['web'],
             'player_skip_formats': ['dash', 'hls']
         }
     }
 }
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('music_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_FILE = 'music_bot.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1'  # Структурированный вывод в JSON
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))  # Ротация по размеру (10 МБ)
+LOG_ROTATE_INTERVAL = int(os.getenv('LOG_ROTATE_INTERVAL', 24 * 3600))  # Ротация по времени (сутки)
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = 10000  # Максимум записей, ожидающих фоновой записи
+LOG_RATE_WINDOW = 60  # Окно ограничения повторяющихся сообщений (секунды)
+LOG_RATE_BURST = 5  # Сколько сообщений из одного места пропускаем за окно
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация файла лога по размеру или по истечении интервала"""
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует записи лога в одну строку JSON"""
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': f"{record.module}:{record.lineno}"
+        }
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает повторяющиеся предупреждения из одного места кода"""
+    def __init__(self, window=LOG_RATE_WINDOW, burst=LOG_RATE_BURST):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._sites: Dict[Tuple[str, int], List] = {}
+        self._lock = threading.Lock()  # Фильтр вызывается из любого потока, до блокировки обработчика
+
+    def filter(self, record):
+        # Ошибки и критические сообщения пропускаем всегда
+        if record.levelno != logging.WARNING:
+            return True
+
+        # Сообщения собираются f-строками, поэтому ключ - место вызова, а не текст
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                suppressed = site[2] if site else 0
+                self._sites[key] = [now, 1, 0]
+            else:
+                site[1] += 1
+                if site[1] <= self.burst:
+                    return True
+                site[2] += 1
+                return False
+
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f"{record.getMessage()} (подавлено похожих сообщений: {suppressed})"
+            record.args = None
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь без форматирования и без блокировки.
+
+    Записи, не поместившиеся в очередь, считаются; как только место появляется,
+    в лог попадает сообщение о том, сколько записей потеряно.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0  # Всего потеряно с запуска
+        self._unreported = 0
+
+    def prepare(self, record):
+        # Форматирование выполняется в фоновом потоке слушателя
+        return record
+
+    def _dropped_record(self) -> logging.LogRecord:
+        return logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+            'msg': f"Очередь лога переполнена, потеряно записей: {self._unreported} (всего {self.dropped})"
+        })
+
+    def enqueue(self, record):
+        # Вызывается под блокировкой обработчика, счетчики меняются из одного потока за раз
+        try:
+            if self._unreported:
+                self.queue.put_nowait(self._dropped_record())
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+    def report_dropped(self):
+        """При завершении дописывает в лог потери, о которых еще не сообщалось"""
+        self.acquire()
+        try:
+            if self._unreported:
+                self.queue.put(self._dropped_record(), timeout=1)
+                self._unreported = 0
+        except queue.Full:
+            pass
+        finally:
+            self.release()
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Настраивает логирование через очередь с фоновой записью"""
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT)
+
+    file_handler = SizeAndTimeRotatingFileHandler(
+        LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    # atexit вызывает функции в обратном порядке: отчет о потерях попадет в лог до остановки слушателя
+    atexit.register(queue_handler.report_dropped)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 class YouTubeAccessError(Exception):
     """Ошибка доступа к YouTube"""
     pass
 
+class Track(NamedTuple):
+    """Трек в очереди: первые два поля совместимы со старым кортежем (url, title)"""
+    url: str
+    title: str
+    duration: float = 0.0
+    video_id: Optional[str] = None
+
 # Оптимизированный кэш с TTL
 class TTLCache:
     def __init__(self, max_size=1000, ttl=3600):
@@ -87,6 +357,13 @@ class TTLCache:
         self.max_size = max_size
         self.ttl = ttl
 
+    def resize(self, max_size: int, ttl: float):
+        """Меняет лимиты на лету, вытесняя самые старые записи"""
+        self.max_size = max_size
+        self.ttl = ttl
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
     def get(self, key):
         if key in self.cache:
             value, timestamp = self.cache[key]
@@ -110,16 +387,554 @@ class TTLCache:
             del self.cache[k]
 
 # Создаем экземпляр кэша
-audio_cache = TTLCache(max_size=1000, ttl=3600)
+AUDIO_CACHE_SIZE = 1000  # Максимум результатов извлечения в памяти
+AUDIO_CACHE_TTL = 3600  # Время жизни результата извлечения (секунды)
+audio_cache = TTLCache(max_size=AUDIO_CACHE_SIZE, ttl=AUDIO_CACHE_TTL)
 
 # Кэш для хранения информации о треках
 track_cache: Dict[str, Tuple[str, str, float]] = {}
 CACHE_DURATION = 3600  # 1 час
 
+class FairQueue:
+    """Очередь с дефицитным циклическим обходом (deficit round robin) по арендаторам.
+
+    У каждого арендатора (сервера) свой FIFO-поток. За ход арендатор получает
+    столько задач, сколько накопил дефицита, а дефицит пополняется на его вес,
+    поэтому при постоянной нагрузке доли потоков пропорциональны весам, как бы
+    много задач ни поставил один сервер.
+    """
+    def __init__(self):
+        self._flows: Dict[Any, deque] = {}
+        self._deficit: Dict[Any, float] = {}
+        self._rotation: deque = deque()  # Арендаторы с задачами в порядке обхода
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def push(self, tenant: Any, item: tuple, weight: float):
+        flow = self._flows.get(tenant)
+        if flow is None:
+            flow = self._flows[tenant] = deque()
+            self._deficit[tenant] = weight
+            self._rotation.append(tenant)
+        flow.append(item)
+        self._len += 1
+
+    def pop(self, weight: Callable[[Any], float], eligible: Callable[[Any], bool]) -> Optional[Tuple[Any, tuple]]:
+        """Следующая задача по DRR; арендаторы, упершиеся в лимит, пропускаются без потери хода"""
+        blocked = 0
+        while blocked < len(self._rotation):
+            tenant = self._rotation[0]
+            if not eligible(tenant):
+                self._rotation.rotate(-1)
+                blocked += 1
+                continue
+            if self._deficit[tenant] < 1:
+                # Вес меньше единицы: задача достается раз в несколько обходов.
+                # Дефицит вырос, значит обход продвинулся - заблокированных считаем заново
+                self._deficit[tenant] += weight(tenant)
+                self._rotation.rotate(-1)
+                blocked = 0
+                continue
+
+            flow = self._flows[tenant]
+            item = flow.popleft()
+            self._len -= 1
+            self._deficit[tenant] -= 1
+            if not flow:
+                # Опустевший поток выходит из обхода и не копит дефицит
+                self._rotation.popleft()
+                del self._flows[tenant]
+                del self._deficit[tenant]
+            elif self._deficit[tenant] < 1:
+                self._deficit[tenant] += weight(tenant)
+                self._rotation.rotate(-1)
+            return tenant, item
+        return None
+
+    def drain(self) -> List[tuple]:
+        items = [item for flow in self._flows.values() for item in flow]
+        self._flows.clear()
+        self._deficit.clear()
+        self._rotation.clear()
+        self._len = 0
+        return items
+
+    def waiting(self) -> Dict[Any, Tuple[int, int, float]]:
+        """Арендатор -> (место в обходе, задач в очереди, время постановки самой старой)"""
+        return {
+            tenant: (position, len(self._flows[tenant]), self._flows[tenant][0][-1])
+            for position, tenant in enumerate(self._rotation)
+        }
+
+class WorkPool(Executor):
+    """Ограниченный пул потоков с приоритетами и справедливой очередью по серверам.
+
+    Задачи с меньшим приоритетом выполняются первыми, а фоновые занимают не больше
+    background_limit потоков - остальные всегда свободны для интерактивных запросов.
+    Уже запущенную задачу прервать нельзя, поэтому резерв и заменяет вытеснение.
+    Внутри приоритета задачи разных арендаторов чередуются по FairQueue, а
+    tenant_limit ограничивает число одновременно выполняемых задач одного арендатора.
+    Задачи без арендатора (None) лимитом не ограничены.
+    """
+    def __init__(self, name: str, max_workers: int, background_limit: Optional[int] = None,
+                 tenant_limit: Optional[int] = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.background_limit = self._background_limit(max_workers, background_limit)
+        self.tenant_limit = tenant_limit
+        self.weights: Dict[Any, float] = {}  # Арендатор -> вес, по умолчанию 1
+        self.running = 0
+        self.running_background = 0
+        self.completed = 0
+        self._queues: Dict[int, FairQueue] = {}  # Приоритет -> очередь
+        self._queued = 0
+        self._inflight: Dict[Any, int] = {}  # Арендатор -> выполняемые задачи
+        self._waits = deque(maxlen=WORK_POOL_WAIT_SAMPLES)  # Время ожидания в очереди (секунды)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._idle = 0
+        self._shutdown = False
+
+    def submit(self, fn, *args, priority: int = PRIORITY_BACKGROUND, tenant: Any = None, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError(f"Пул {self.name} остановлен")
+            queue = self._queues.get(priority)
+            if queue is None:
+                queue = self._queues[priority] = FairQueue()
+                self._queues = dict(sorted(self._queues.items()))
+            queue.push(tenant, (future, fn, args, kwargs, time.monotonic()), self._weight(tenant))
+            self._queued += 1
+            if self._queued > self._idle and len(self._threads) < self.max_workers:
+                self._spawn_worker()
+            self._cond.notify()
+        return future
+
+    def resize(self, max_workers: int, background_limit: Optional[int] = None):
+        """Меняет размер пула на лету: лишние потоки завершаются, дойдя до простоя"""
+        with self._cond:
+            self.max_workers = max_workers
+            self.background_limit = self._background_limit(max_workers, background_limit)
+            while len(self._threads) < min(self.max_workers, self._queued):
+                self._spawn_worker()
+            self._cond.notify_all()
+
+    def set_limits(self, tenant_limit: Optional[int], weights: Dict[Any, float]):
+        """Меняет лимит и веса арендаторов; новые веса действуют со следующего хода"""
+        with self._cond:
+            self.tenant_limit = tenant_limit
+            self.weights = dict(weights)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _background_limit(max_workers: int, background_limit: Optional[int]) -> int:
+        # 0 - не "без ограничения", а пул, в котором фоновые задачи никогда не запустятся
+        if background_limit is None:
+            return max_workers
+        if not 0 < background_limit <= max_workers:
+            raise ValueError(f"background_limit должен быть от 1 до {max_workers}, получено {background_limit}")
+        return background_limit
+
+    def _spawn_worker(self):
+        thread = threading.Thread(target=self._worker, name=f"{self.name}-{next(self._seq)}", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def run(self, fn, *args, priority: int = PRIORITY_BACKGROUND, tenant: Any = None) -> asyncio.Future:
+        """То же, что submit, но возвращает asyncio.Future; его отмена снимает задачу из очереди"""
+        return asyncio.wrap_future(self.submit(fn, *args, priority=priority, tenant=tenant))
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for queue in self._queues.values():
+                    for item in queue.drain():
+                        item[0].cancel()
+                self._queued = 0
+            self._cond.notify_all()
+        if wait:
+            for thread in list(self._threads):
+                thread.join()
+
+    def stats(self) -> dict:
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                'name': self.name,
+                'workers': self.max_workers,
+                'running': self.running,
+                'queued': self._queued,
+                'completed': self.completed,
+                'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+                'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0
+            }
+
+    def tenants(self) -> List[dict]:
+        """Кто кого ждет: очередь, выполняемые задачи и место в обходе по арендаторам"""
+        now = time.monotonic()
+        with self._cond:
+            report: Dict[Any, dict] = {}
+            for priority, queue in self._queues.items():
+                for tenant, (position, queued, oldest) in queue.waiting().items():
+                    entry = report.setdefault(tenant, {
+                        'tenant': tenant, 'priority': priority, 'position': position,
+                        'queued': 0, 'running': 0, 'oldest_wait': 0.0
+                    })
+                    entry['queued'] += queued
+                    entry['oldest_wait'] = max(entry['oldest_wait'], now - oldest)
+            for tenant, running in self._inflight.items():
+                report.setdefault(tenant, {
+                    'tenant': tenant, 'priority': None, 'position': None,
+                    'queued': 0, 'running': 0, 'oldest_wait': 0.0
+                })['running'] = running
+        return sorted(report.values(), key=lambda t: (-t['queued'], -t['running']))
+
+    def _weight(self, tenant: Any) -> float:
+        return max(FAIR_QUEUE_MIN_WEIGHT, self.weights.get(tenant, 1.0))
+
+    def _eligible(self, tenant: Any) -> bool:
+        return tenant is None or self.tenant_limit is None or self._inflight.get(tenant, 0) < self.tenant_limit
+
+    def _take(self) -> Optional[Tuple[int, Any, tuple]]:
+        # Фоновые задачи берутся, только если ни одну интерактивную запустить нельзя
+        for priority, queue in self._queues.items():
+            if priority >= PRIORITY_BACKGROUND and self.running_background >= self.background_limit:
+                return None
+            picked = queue.pop(self._weight, self._eligible)
+            if picked:
+                return (priority, *picked)
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    picked = self._take()
+                    if picked:
+                        break
+                    if self._shutdown and not self._queued:
+                        return
+                    if len(self._threads) > self.max_workers:
+                        self._threads.remove(threading.current_thread())
+                        return
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                priority, tenant, (future, fn, args, kwargs, enqueued) = picked
+                background = priority >= PRIORITY_BACKGROUND
+                self._queued -= 1
+                self._waits.append(time.monotonic() - enqueued)
+                self._inflight[tenant] = self._inflight.get(tenant, 0) + 1
+                self.running += 1
+                self.running_background += background
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    self.running_background -= background
+                    self._inflight[tenant] -= 1
+                    if not self._inflight[tenant]:
+                        del self._inflight[tenant]
+                    self.completed += 1
+                    if self.tenant_limit:
+                        # Освободившийся слот арендатора может разблокировать его задачу у любого потока
+                        self._cond.notify_all()
+                    else:
+                        self._cond.notify()
+
+spawn_pool = WorkPool('ffmpeg-spawn', SPAWN_WORKERS)
+disk_pool = WorkPool('disk-io', DISK_WORKERS)
+
+class QueueFullError(Exception):
+    """Очередь достигла максимального размера"""
+    pass
+
+class DuplicateTrackError(Exception):
+    """Трек уже в очереди, и политика сервера не разрешает еще одну копию"""
+    pass
+
+class DedupPolicy(NamedTuple):
+    max_copies: int = 0  # 0 - без ограничений
+    collapse_playlists: bool = False  # Повторы из плейлиста и уже стоящие в очереди треки отбрасываются
+
+class DedupPolicyStore:
+    """Политики повторов по серверам, сохраняемые на диск.
+
+    Состояние сервера удаляется при простое и командой /fix, а политика,
+    заданная администратором, должна пережить и это, и перезапуск.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._policies: Dict[int, DedupPolicy] = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._policies = {
+                int(guild_id): DedupPolicy(int(copies), bool(collapse))
+                for guild_id, (copies, collapse) in data.items()
+            }
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать политики повторов: {e}")
+
+    def _save(self, data: Dict[str, list]):
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения политик повторов: {e}")
+
+    def get(self, guild_id: Optional[int]) -> DedupPolicy:
+        return self._policies.get(guild_id) or DedupPolicy(DEDUP_MAX_COPIES, DEDUP_COLLAPSE_PLAYLISTS)
+
+    def set(self, guild_id: int, policy: DedupPolicy):
+        self._policies[guild_id] = policy
+        snapshot = {str(g): list(p) for g, p in self._policies.items()}
+        disk_pool.submit(self._save, snapshot)
+
+dedup_policies = DedupPolicyStore(DEDUP_POLICIES_FILE)
+
+def parse_video_id(query: str) -> Optional[str]:
+    """Id видео из ссылки YouTube без обращения к сети"""
+    if query.startswith(LOCAL_PREFIX):
+        return None  # local:<название> не совпадает с id файла, повтор проверяется после поиска
+    match = YOUTUBE_ID_RE.search(query)
+    return match.group(1) if match else None
+
+class TrackQueue:
+    """Очередь треков на блочном списке с индексом Фенвика по размерам блоков.
+
+    Позиционные операции (взятие, вставка, удаление, перемещение) работают
+    за O(log n) на поиск блока плюс O(QUEUE_BLOCK_SIZE) внутри блока. Деление
+    переполненного блока и удаление опустевшего сдвигают список блоков и
+    перестраивают индекс за O(n / QUEUE_BLOCK_SIZE); это случается не чаще
+    раза на QUEUE_BLOCK_SIZE операций, так что в среднем выходит
+    O(log n + QUEUE_BLOCK_SIZE).
+    """
+    def __init__(self, maxlen: Optional[int] = None):
+        self.maxlen = maxlen
+        self.version = 0  # Увеличивается при каждом изменении
+        self._blocks: List[list] = []
+        self._tree: List[int] = [0]
+        self._len = 0
+
+    # Индекс Фенвика по длинам блоков
+    def _rebuild_index(self):
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update_index(self, block_idx: int, delta: int):
+        i = block_idx + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        """Находит (номер блока, позиция в блоке) для индекса"""
+        pos = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= index:
+                index -= self._tree[nxt]
+                pos = nxt
+            step >>= 1
+        return pos, index
+
+    def _normalize(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("Индекс вне очереди")
+        return index
+
+    def _changed(self):
+        self.version += 1
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __bool__(self) -> bool:
+        return self._len > 0
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, index: int):
+        block_idx, pos = self._locate(self._normalize(index))
+        return self._blocks[block_idx][pos]
+
+    def free_slots(self) -> int:
+        """Сколько треков еще поместится в очередь"""
+        if self.maxlen is None:
+            return sys.maxsize
+        return max(0, self.maxlen - self._len)
+
+    def slice(self, start: int, stop: int) -> List:
+        """Возвращает элементы [start, stop) без обхода всей очереди"""
+        start = max(0, start)
+        stop = min(stop, self._len)
+        result = []
+        if start >= stop:
+            return result
+        block_idx, pos = self._locate(start)
+        while len(result) < stop - start:
+            block = self._blocks[block_idx]
+            result.extend(block[pos:pos + (stop - start - len(result))])
+            block_idx += 1
+            pos = 0
+        return result
+
+    def insert(self, index: int, item):
+        """Вставляет элемент перед позицией index"""
+        if not self.free_slots():
+            raise QueueFullError("Очередь переполнена")
+        index = max(0, min(index if index >= 0 else index + self._len, self._len))
+
+        if not self._blocks:
+            self._blocks.append([item])
+            self._rebuild_index()
+        else:
+            if index == self._len:
+                block_idx, pos = len(self._blocks) - 1, len(self._blocks[-1])
+            else:
+                block_idx, pos = self._locate(index)
+            block = self._blocks[block_idx]
+            block.insert(pos, item)
+            if len(block) > 2 * QUEUE_BLOCK_SIZE:
+                # Делим переполненный блок пополам
+                self._blocks[block_idx:block_idx + 1] = [block[:QUEUE_BLOCK_SIZE], block[QUEUE_BLOCK_SIZE:]]
+                self._rebuild_index()
+            else:
+                self._update_index(block_idx, 1)
+
+        self._len += 1
+        self._changed()
+
+    def append(self, item):
+        self.insert(self._len, item)
+
+    def appendleft(self, item):
+        self.insert(0, item)
+
+    def pop(self, index: int = -1):
+        """Удаляет и возвращает элемент по индексу"""
+        block_idx, pos = self._locate(self._normalize(index))
+        block = self._blocks[block_idx]
+        item = block.pop(pos)
+        if not block:
+            del self._blocks[block_idx]
+            self._rebuild_index()
+        else:
+            self._update_index(block_idx, -1)
+        self._len -= 1
+        self._changed()
+        return item
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError("Очередь пуста")
+        return self.pop(0)
+
+    def move(self, src: int, dst: int):
+        """Перемещает элемент с позиции src на позицию dst"""
+        item = self.pop(src)
+        self.insert(dst, item)
+        return item
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def shuffle(self):
+        """Перемешивает очередь за O(n)"""
+        items = list(self)
+        random.shuffle(items)
+        self._blocks = [items[i:i + QUEUE_BLOCK_SIZE] for i in range(0, len(items), QUEUE_BLOCK_SIZE)]
+        self._rebuild_index()
+        self._changed()
+
+    def clear(self):
+        self._blocks = []
+        self._tree = [0]
+        self._len = 0
+        self._changed()
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
+class StartupTimer:
+    """Замеряет длительность этапов запуска"""
+    def __init__(self, started: float):
+        self._last = started
+        self.phases: List[Tuple[str, float]] = []
+        self.reported = False
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        total = sum(duration for _, duration in self.phases)
+        details = ", ".join(f"{phase}: {duration:.2f} с" for phase, duration in self.phases)
+        logger.info(f"Запуск занял {total:.2f} с ({details})")
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+
+def command_tree_hash(tree: app_commands.CommandTree) -> str:
+    """Считает хэш глобального дерева слэш-команд"""
+    payload = sorted((cmd.to_dict() for cmd in tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_command_hash() -> Optional[str]:
+    try:
+        with open(COMMAND_HASH_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_command_hash(value: str):
+    try:
+        with open(COMMAND_HASH_FILE, 'w', encoding='utf-8') as f:
+            f.write(value)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить хэш команд: {e}")
+
+def warm_up_youtube_dl():
+    """Импортирует yt-dlp и загружает экстракторы (выполняется в отдельном потоке)"""
+    youtube_dl.load()
+    create_ydl({'quiet': True}).get_info_extractor('Youtube')
+
 class MusicBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default()
@@ -133,32 +948,67 @@ class MusicBot(commands.Bot):
             case_insensitive=True
         )
         self.voice_states = {}
+        self.control_view: Optional[View] = None
         self._cleanup_task = None
+        self._warmup_task = None
         self._is_shutting_down = False
 
     async def setup_hook(self):
         """Вызывается при запуске бота"""
+        # Постоянная панель управления регистрируется один раз на весь процесс
+        self.control_view = MusicControlView()
+        self.add_view(self.control_view)
+
+        self._cleanup_task = self.loop.create_task(self._cleanup_states())
+        now_playing_updater.start()
+        disk_monitor.start()
+        loop_lag_monitor.start()
+        local_library.start()
+        disk_pool.submit(opus_cache.load)
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                # kill -HUP перечитывает настройки без перезапуска
+                self.loop.add_signal_handler(signal.SIGHUP, runtime_settings.schedule_reload)
+            except NotImplementedError:
+                pass
+        if NORMALIZE_VOLUME:
+            loudness_analyzer.start()
+
         try:
-            # Принудительная синхронизация всех команд
-            commands = await self.tree.sync()
-            logger.info(f"Слэш-команды синхронизированы! Количество команд: {len(commands)}")
-            for cmd in commands:
-                logger.info(f"Синхронизирована команда: /{cmd.name}")
-            self._cleanup_task = self.loop.create_task(self._cleanup_states())
+            # Синхронизируем команды только если дерево изменилось с прошлого запуска
+            tree_hash = command_tree_hash(self.tree)
+            if FORCE_COMMAND_SYNC or tree_hash != read_command_hash():
+                commands = await self.tree.sync()
+                write_command_hash(tree_hash)
+                logger.info(f"Слэш-команды синхронизированы! Количество команд: {len(commands)}")
+                for cmd in commands:
+                    logger.info(f"Синхронизирована команда: /{cmd.name}")
+            else:
+                logger.info("Дерево команд не изменилось, синхронизация пропущена")
         except Exception as e:
             logger.error(f"Ошибка синхронизации команд: {e}")
+        startup_timer.mark("setup_hook")
 
     async def close(self):
         """Корректное завершение работы бота"""
         self._is_shutting_down = True
         
-        if self._cleanup_task:
-            self._cleanup_task.cancel()
-            try:
-                await self._cleanup_task
-            except asyncio.CancelledError:
-                pass
+        for task in (self._cleanup_task, self._warmup_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
         
+        await now_playing_updater.stop()
+        await disk_monitor.stop()
+        await loop_lag_monitor.stop()
+        await local_library.stop()
+        await loudness_analyzer.stop()
+        for station in broadcast_stations.values():
+            station.stop()
+
         # Отключаем все голосовые соединения
         for guild_id, state in guild_states.items():
             try:
@@ -192,7 +1042,9 @@ class MusicBot(commands.Bot):
         audio_cache.clear_expired()
         track_cache.clear()
         
-        # Закрываем YouTube клиент
+        # Сохраняем cookies и индекс названий, закрываем YouTube клиент
+        cookie_jar.flush()
+        title_index.save()
         await youtube_client.close()
         
         await super().close()
@@ -205,6 +1057,14 @@ class MusicBot(commands.Bot):
                 
                 # Очищаем истекшие записи в кэше
                 audio_cache.clear_expired()
+
+                # Сохраняем обновленные cookies пачкой
+                await disk_pool.run(cookie_jar.flush)
+
+                # Индекс названий пишется периодически, чтобы падение не теряло статистику
+                title_snapshot = title_index.snapshot()
+                if title_snapshot:
+                    await disk_pool.run(title_index.save, title_snapshot)
                 
                 # Проверяем все состояния серверов
                 for guild_id, state in list(guild_states.items()):
@@ -238,13 +1098,162 @@ class MusicBot(commands.Bot):
         for cmd in self.tree.get_commands():
             logger.info(f"/{cmd.name} - {cmd.description}")
 
+        if not self._warmup_task:
+            startup_timer.mark("подключение к Discord")
+            self._warmup_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        """Прогревает yt-dlp в фоне, не задерживая подключение к Discord"""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, warm_up_youtube_dl)
+            startup_timer.mark("прогрев yt-dlp")
+        except Exception as e:
+            logger.error(f"Ошибка прогрева yt-dlp: {e}")
+        startup_timer.report()
+
 bot = MusicBot()
 
-# Добавляем константу для максимального размера очереди
-MAX_QUEUE_SIZE = 50  # Максимальное количество треков в очереди
+# Количество треков на одной странице /queue
+QUEUE_PAGE_SIZE = 10
+
+# Обновление сообщения о текущем треке
+FRAME_DURATION = 0.02  # Длительность одного аудио кадра Discord (20 мс)
+NOW_PLAYING_INTERVAL = 10  # Базовый интервал обновления прогресса (секунды)
+NOW_PLAYING_IDLE_AFTER = 300  # Через сколько секунд без команд обновляем реже
+NOW_PLAYING_EDITS_PER_TICK = 10  # Максимум правок сообщений за один проход
+NOW_PLAYING_CHANNEL_EDITS = 1  # Не больше 1 правки на канал
+NOW_PLAYING_CHANNEL_PERIOD = 5.0  # за 5 секунд
+PROGRESS_BAR_LENGTH = 15
+
+# Радио-режим: один поток на много голосовых каналов
+OPUS_SILENCE = b'\xf8\xff\xfe'  # Пакет тишины Opus
+BROADCAST_BITRATE = 96  # Битрейт Opus для радио (кбит/с)
+BROADCAST_BUFFER_PACKETS = 500  # Размер кольцевого буфера (10 секунд)
+BROADCAST_JOIN_DELAY_PACKETS = 10  # Новый слушатель стартует на 200 мс позади для запаса
+
+# Автодополнение /play
+TITLE_INDEX_FILE = 'title_index.json'
+TITLE_INDEX_MAX_WORDS = 8  # С каких слов названия можно начинать ввод
+TITLE_INDEX_SCAN_LIMIT = 200  # Максимум ключей, просматриваемых на запрос
+TITLE_INDEX_GUILD_WEIGHT = 10  # Вес популярности на своем сервере относительно глобальной
+
+# Локальная музыкальная библиотека
+LIBRARY_DIRS = [d for d in os.getenv('MUSIC_LIBRARY_DIRS', '').split(os.pathsep) if d]
+LIBRARY_INDEX_FILE = 'library_index.jsonl'
+LIBRARY_EXTENSIONS = {'.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma'}
+LIBRARY_RESCAN_INTERVAL = int(os.getenv('LIBRARY_RESCAN_INTERVAL', 1800))  # Период пересканирования (секунды)
+LIBRARY_SORT_CHUNK = 20000  # Ключи сортируются частями, чтобы поток сканирования не держал GIL подолгу
+LOCAL_PREFIX = 'local:'  # Префикс запроса /play и id трека из локальной библиотеки
+LOCAL_FFMPEG_OPTIONS = {
+    'before_options': '',
+    'options': '-vn'
+}
+
+# Контроль места на диске
+DISK_CHECK_INTERVAL = 60  # Как часто замерять свободное место (секунды)
+DISK_LOW_GB = 0.5  # Порог нехватки места, начинаем чистить временные файлы
+DISK_CRITICAL_GB = 0.1  # Критический порог
+TEMP_CLEANUP_MAX_ENTRIES = 2000  # Максимум просмотренных файлов за проход очистки
+TEMP_CLEANUP_MAX_DELETES = 200  # Максимум удаленных файлов за проход очистки
+temp_cleanup_entries = None  # Незаконченный os.scandir: следующий проход очистки продолжает его
+temp_cleanup_lock = threading.Lock()  # Очистку вызывают монитор диска и проверка перед запуском
+
+# Кэш закодированных Opus-пакетов популярных треков
+OPUS_CACHE_DIR = os.getenv('OPUS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ds_ytbot_opus_cache'))
+OPUS_CACHE_MAX_MB = int(os.getenv('OPUS_CACHE_MAX_MB', 2048))  # Объем кэша, 0 отключает его
+OPUS_CACHE_BITRATE = 128  # Битрейт кодирования кэшируемых треков (кбит/с)
+OPUS_CACHE_MAX_DURATION = 1200  # Треки длиннее 20 минут не кэшируются
+OPUS_CACHE_COMPLETE_RATIO = 0.98  # Какая доля длительности должна быть проиграна, чтобы файл считался целым
+
+STATS_MAX_GUILDS = 15  # Сколько серверов показывать в /stats
+
+# Мониторинг задержки цикла событий
+LOOP_LAG_INTERVAL = 0.1  # Период пульса цикла (секунды)
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))  # Задержка, после которой снимаем стек
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # Границы гистограммы (секунды)
+LOOP_LAG_STACK_LIMIT = 15  # Сколько кадров стека писать в лог
+USE_UVLOOP = os.getenv('USE_UVLOOP', '0') == '1'  # Запуск на uvloop, если он установлен
 
 # Добавляем константу для таймаута воспроизведения
-PLAY_TIMEOUT = 300  # 5 минут максимум на один трек
+PLAY_TIMEOUT = int(os.getenv('PLAY_TIMEOUT', 300))  # 5 минут максимум на один трек
+
+class SharedCookieJar:
+    """Одна cookie-банка в памяти для всех экземпляров YoutubeDL.
+
+    Файл читается один раз и перечитывается только при изменении mtime
+    (проверяется не чаще раза в COOKIE_CHECK_INTERVAL секунд). Обновленные
+    YouTube cookies записываются обратно пачкой при вызове flush().
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._jar = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._saved_signature = None
+        self._lock = threading.Lock()
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _load(self, mtime: Optional[float]):
+        jar = youtube_dl.cookies.YoutubeDLCookieJar(self.path)
+        if mtime is not None:
+            try:
+                jar.load()
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать {self.path}: {e}")
+        self._jar = jar
+        self._mtime = mtime
+        self._saved_signature = self._signature(jar)
+        logger.info(f"Cookies загружены: {len(jar)} шт.")
+
+    @staticmethod
+    def _signature(jar) -> int:
+        return hash(tuple(sorted((c.domain, c.path, c.name, c.value) for c in jar)))
+
+    def get(self):
+        """Возвращает общую cookie-банку, перечитывая файл при его изменении"""
+        now = time.monotonic()
+        if self._jar is not None and now - self._checked_at < COOKIE_CHECK_INTERVAL:
+            return self._jar
+        with self._lock:
+            self._checked_at = now
+            mtime = self._file_mtime()
+            if self._jar is None or mtime != self._mtime:
+                self._load(mtime)
+            return self._jar
+
+    def flush(self):
+        """Записывает cookies в файл, если они изменились (вызывается вне event loop)"""
+        with self._lock:
+            if self._jar is None:
+                return
+            try:
+                # Потоки извлечения меняют банку под ее собственной блокировкой (set_cookie,
+                # extract_cookies), поэтому обход и запись идут под ней же
+                with self._jar._cookies_lock:
+                    signature = self._signature(self._jar)
+                    if signature == self._saved_signature:
+                        return
+                    self._jar.save()
+                self._saved_signature = signature
+                self._mtime = self._file_mtime()
+                logger.info("Обновленные cookies сохранены")
+            except Exception as e:
+                logger.error(f"Ошибка сохранения cookies: {e}")
+
+cookie_jar = SharedCookieJar(COOKIES_FILE)
+
+def create_ydl(ydl_opts: dict) -> 'youtube_dl.YoutubeDL':
+    """Создает YoutubeDL с общей cookie-банкой вместо чтения cookies.txt"""
+    opts = dict(ydl_opts)
+    opts.pop('cookiefile', None)
+    ydl = youtube_dl.YoutubeDL(opts)
+    ydl.cookiejar = cookie_jar.get()
+    return ydl
 
 def check_cookies() -> None:
     """Проверяет наличие и валидность cookies файла"""
@@ -266,8 +1275,6 @@ def get_queue(guild_id: int):
 
 async def connect_to_voice(ctx: commands.Context) -> discord.VoiceClient:
     """Подключение к голосовому каналу"""
-    check_cookies()
-    
     if not ctx.author.voice:
         raise commands.CommandError("Вы должны быть в голосовом канале!")
     
@@ -317,68 +1324,207 @@ async def connect_to_voice(ctx: commands.Context) -> discord.VoiceClient:
     
     raise commands.CommandError("Не удалось подключиться к голосовому каналу")
 
+class GuildSnapshot(NamedTuple):
+    """Состояние сервера на момент чтения"""
+    version: int
+    current_track: Optional[Track]
+    queue_length: int
+    playlist_length: int
+    is_playing: bool
+    playback_state: str
+
 class GuildState:
-    def __init__(self):
-        self.queue = deque(maxlen=MAX_QUEUE_SIZE)  # Используем deque с максимальным размером
-        self.playlist_queue = deque(maxlen=MAX_QUEUE_SIZE)
+    """Состояние сервера в модели актора.
+
+    Очереди меняет только задача-актор, выполняющая команды из почтового ящика
+    по одной и без await внутри, поэтому блокировка не нужна и никогда не
+    удерживается на время сетевых запросов. Чтение идет по снимкам.
+    """
+    def __init__(self, guild_id: Optional[int] = None):
+        self.guild_id = guild_id
+        self.queue = TrackQueue(maxlen=MAX_QUEUE_SIZE)  # Индексированная очередь с ограничением размера
+        self.playlist_queue = TrackQueue(maxlen=MAX_PLAYLIST_SIZE)  # Неизвлеченные записи плейлистов (id и название)
         self.current_track = None
         self.disconnect_timer = None
         self.last_activity = time.time()
         self.voice_client = None
         self.is_playing = False
+        self.playback = PlaybackController(self)  # Переходы между треками без блокировки потока плеера
         self.volume = 1.0
-        self._lock = asyncio.Lock()
+        self.now_playing_message: Optional[discord.Message] = None  # Единственное сообщение о текущем треке
+        self._mailbox: asyncio.Queue = asyncio.Queue()  # Команды, изменяющие очереди
+        self._actor: Optional[asyncio.Task] = None
         self._queue_event = asyncio.Event()  # Для оповещения о новых треках
+        self._page_cache: Dict[Tuple[int, int, Optional[str]], Tuple[str, int]] = {}
+        self._prefetch: Dict[str, asyncio.Task] = {}  # Извлечение ближайших треков плейлиста по id видео
+        self._queued_ids: Dict[str, int] = {}  # id видео -> число копий в обеих очередях
+        self.dedup_policy = dedup_policies.get(guild_id)
 
-    async def add_to_queue(self, tracks: Union[Tuple[str, str], List[Union[Tuple[str, str], dict]]]) -> int:
-        """Добавляет трек или треки в очередь с блокировкой"""
-        async with self._lock:
-            added_count = 0
-            
-            if isinstance(tracks, tuple):
-                if len(self.queue) < MAX_QUEUE_SIZE:
-                    # Добавляем случайную задержку от 10 до 15 секунд
-                    await asyncio.sleep(random.uniform(10, 15))
-                    self.queue.append(tracks)
-                    added_count = 1
-                    self._queue_event.set()
+    @property
+    def target_bitrate(self) -> Optional[int]:
+        """Битрейт текущего голосового канала в кбит/с"""
+        if self.voice_client and self.voice_client.channel:
+            return self.voice_client.channel.bitrate // 1000
+        return None
+
+    @property
+    def version(self) -> int:
+        """Версия очередей, меняется при любом их изменении"""
+        return self.queue.version + self.playlist_queue.version
+
+    @staticmethod
+    def _item_id(item: Union[Track, dict]) -> Optional[str]:
+        return item.video_id if isinstance(item, tuple) else item.get('id')
+
+    def _index_add(self, item: Union[Track, dict]):
+        video_id = self._item_id(item)
+        if video_id:
+            self._queued_ids[video_id] = self._queued_ids.get(video_id, 0) + 1
+
+    def _index_remove(self, item: Union[Track, dict]):
+        video_id = self._item_id(item)
+        count = self._queued_ids.get(video_id, 0)
+        if count > 1:
+            self._queued_ids[video_id] = count - 1
+        elif count:
+            del self._queued_ids[video_id]
+
+    def queued_copies(self, video_id: str) -> int:
+        """Сколько раз видео стоит в очереди (за O(1))"""
+        return self._queued_ids.get(video_id, 0)
+
+    def admits(self, video_id: Optional[str]) -> bool:
+        """Разрешает ли политика сервера добавить еще одну копию видео"""
+        max_copies = self.dedup_policy.max_copies
+        return not video_id or not max_copies or self.queued_copies(video_id) < max_copies
+
+    def _call(self, handler, *args) -> asyncio.Future:
+        """Кладет команду в почтовый ящик сервера и возвращает future с ее результатом"""
+        future = asyncio.get_running_loop().create_future()
+        self._mailbox.put_nowait((handler, args, future))
+        # Актор живет, пока в ящике есть команды, простаивающие серверы задачу не держат
+        if not self._actor or self._actor.done():
+            self._actor = asyncio.create_task(self._run_actor())
+        return future
+
+    async def _run_actor(self):
+        """Единственный владелец очередей: выполняет команды по одной, без ожиданий внутри"""
+        while not self._mailbox.empty():
+            handler, args, future = self._mailbox.get_nowait()
+            if future.cancelled():
+                continue
+            try:
+                result = handler(*args)
+            except Exception as e:
+                future.set_exception(e)
             else:
-                available_slots = MAX_QUEUE_SIZE - len(self.queue)
-                if available_slots > 0:
-                    # Фильтруем и добавляем треки
-                    for track in tracks[:available_slots]:
-                        if isinstance(track, tuple):
-                            # Добавляем случайную задержку от 10 до 15 секунд
-                            await asyncio.sleep(random.uniform(10, 15))
-                            self.queue.append(track)
-                            added_count += 1
-                        else:
-                            self.playlist_queue.append(track)
-                            added_count += 1
-                    if added_count > 0:
-                        self._queue_event.set()
-            
-            self.update_activity()
-            return added_count
+                future.set_result(result)
+            await asyncio.sleep(0)  # Длинная пачка команд не занимает цикл целиком
 
-    async def get_next_track(self) -> Optional[Tuple[str, str]]:
-        """Получает следующий трек из очереди"""
-        async with self._lock:
-            if self.queue:
-                return self.queue.popleft()
-            
-            while self.playlist_queue:
-                entry = self.playlist_queue.popleft()
-                try:
-                    track_info = await process_playlist_entry(entry)
-                    if track_info:
-                        return track_info
-                except Exception as e:
-                    logger.warning(f"Ошибка обработки трека из плейлиста: {str(e)}")
+    def snapshot(self) -> GuildSnapshot:
+        """Неизменяемый снимок для чтения без обращения к актору"""
+        return GuildSnapshot(
+            self.version,
+            self.current_track,
+            len(self.queue),
+            len(self.playlist_queue),
+            self.is_playing,
+            self.playback.state
+        )
+
+    async def add_to_queue(self, tracks: Union[Track, List[Union[Track, dict]]], play_next: bool = False) -> int:
+        """Добавляет трек или треки в очередь"""
+        return await self._call(self._add_to_queue, tracks, play_next)
+
+    def _add_to_queue(self, tracks: Union[Track, List[Union[Track, dict]]], play_next: bool) -> int:
+        added_count = 0
+        
+        if isinstance(tracks, tuple):
+            if not self.admits(tracks.video_id):
+                raise DuplicateTrackError(tracks.title)
+            if self.queue.free_slots():
+                if play_next:
+                    self.queue.appendleft(tracks)
+                else:
+                    self.queue.append(tracks)
+                self._index_add(tracks)
+                added_count = 1
+        else:
+            collapse = self.dedup_policy.collapse_playlists
+            # Фильтруем и добавляем треки; повторы отбрасываются до извлечения потоков
+            for track in tracks:
+                video_id = self._item_id(track)
+                if collapse and video_id and self.queued_copies(video_id) or not self.admits(video_id):
                     continue
-            
-            self._queue_event.clear()
-            return None
+                if isinstance(track, tuple):
+                    if not self.queue.free_slots():
+                        continue
+                    self.queue.append(track)
+                else:
+                    if not self.playlist_queue.free_slots():
+                        break
+                    self.playlist_queue.append(track)
+                self._index_add(track)
+                added_count += 1
+        
+        if added_count > 0:
+            self._queue_event.set()
+        self._schedule_prefetch()
+        self.update_activity()
+        return added_count
+
+    def _schedule_prefetch(self):
+        """Заранее извлекает треки плейлиста в небольшом окне перед текущей позицией"""
+        window = PLAYLIST_PREFETCH_WINDOW - len(self.queue)
+        if window <= 0:
+            return
+        for entry in self.playlist_queue.slice(0, window):
+            if entry['id'] not in self._prefetch:
+                self._prefetch[entry['id']] = asyncio.create_task(
+                    process_playlist_entry(entry, self.target_bitrate, guild_id=self.guild_id)
+                )
+
+    def _cancel_prefetch(self):
+        for task in self._prefetch.values():
+            task.cancel()
+        self._prefetch.clear()
+
+    async def get_next_track(self) -> Optional[Track]:
+        """Получает следующий трек из очереди.
+
+        Актор только снимает запись с очереди; извлечение трека плейлиста
+        ждется уже вне него, чтобы команды сервера не стояли за сетью.
+        """
+        while True:
+            track, entry, task = await self._call(self._take_next)
+            if track or not entry:
+                return track
+            try:
+                # Трек нужен прямо сейчас, поэтому без предзагрузки он идет вне фоновой очереди
+                track_info = await (task or process_playlist_entry(entry, self.target_bitrate, PRIORITY_INTERACTIVE, self.guild_id))
+                if track_info:
+                    return track_info
+            except Exception as e:
+                logger.warning(f"Ошибка обработки трека из плейлиста: {str(e)}")
+
+    def _take_next(self) -> Tuple[Optional[Track], Optional[dict], Optional[asyncio.Task]]:
+        if self.queue:
+            track = self.queue.popleft()
+            self._index_remove(track)
+            self._schedule_prefetch()
+            return track, None, None
+        
+        if self.playlist_queue:
+            entry = self.playlist_queue.popleft()
+            self._index_remove(entry)
+            task = self._prefetch.pop(entry['id'], None)
+            if task and task.cancelled():
+                task = None
+            self._schedule_prefetch()
+            return None, entry, task
+        
+        self._queue_event.clear()
+        return None, None, None
 
     async def wait_for_tracks(self, timeout: float = None) -> bool:
         """Ожидает появления новых треков в очереди"""
@@ -388,24 +1534,89 @@ class GuildState:
         except asyncio.TimeoutError:
             return False
 
+    async def remove_track(self, index: int) -> Track:
+        """Удаляет трек из очереди по индексу (с нуля)"""
+        return await self._call(self._remove_track, index)
+
+    def _remove_track(self, index: int) -> Track:
+        track = self.queue.pop(index)
+        self._index_remove(track)
+        self.update_activity()
+        return track
+
+    async def move_track(self, src: int, dst: int) -> Track:
+        """Перемещает трек в очереди с позиции src на позицию dst (с нуля)"""
+        return await self._call(self._move_track, src, dst)
+
+    def _move_track(self, src: int, dst: int) -> Track:
+        track = self.queue.move(src, dst)
+        self.update_activity()
+        return track
+
+    async def shuffle_queue(self):
+        """Перемешивает очередь"""
+        await self._call(self._shuffle_queue)
+
+    def _shuffle_queue(self):
+        self.queue.shuffle()
+        self.update_activity()
+
     def get_queue_length(self) -> int:
         """Возвращает текущую длину очереди"""
         return len(self.queue) + len(self.playlist_queue)
 
     async def clear_queue(self):
         """Очищает очередь"""
-        async with self._lock:
-            self.queue.clear()
-            self.playlist_queue.clear()
-            self._queue_event.clear()
-            self.update_activity()
+        await self._call(self._clear_queue)
 
-    def update_activity(self):
+    def _clear_queue(self):
+        self.queue.clear()
+        self.playlist_queue.clear()
+        self._queued_ids.clear()
+        self._cancel_prefetch()
+        self._queue_event.clear()
+        self.update_activity()
+
+    def render_queue_page(self, page: int) -> Tuple[str, int]:
+        """Возвращает текст одной страницы очереди и общее число страниц"""
+        total_pages = max(1, -(-len(self.queue) // QUEUE_PAGE_SIZE))
+        page = max(0, min(page, total_pages - 1))
+        current_title = self.current_track.title if self.current_track else None
+
+        key = (self.version, page, current_title)
+        cached = self._page_cache.get(key)
+        if cached:
+            return cached
+        if any(k[0] != key[0] for k in self._page_cache):
+            self._page_cache.clear()
+
+        lines = []
+        if current_title:
+            lines.append(f"🎵 **Сейчас играет:** {current_title}\n")
+
+        if self.queue:
+            lines.append(f"📋 В очереди ({len(self.queue)}/{MAX_QUEUE_SIZE}):")
+            start = page * QUEUE_PAGE_SIZE
+            page_tracks = self.queue.slice(start, start + QUEUE_PAGE_SIZE)
+            for idx, track in enumerate(page_tracks, start + 1):
+                lines.append(f"{idx}. {track.title}")
+
+        if self.playlist_queue:
+            lines.append(f"\n⏳ Ожидают загрузки из плейлиста: {len(self.playlist_queue)}")
+
+        result = ("\n".join(lines), total_pages)
+        self._page_cache[key] = result
+        return result
+
+    def update_activity(self):
         self.last_activity = time.time()
 
     def clear(self):
         """Очищает состояние сервера"""
         self.queue.clear()
+        self.playlist_queue.clear()
+        self._queued_ids.clear()
+        self._cancel_prefetch()
         self.current_track = None
         self.is_playing = False
         if self.disconnect_timer:
@@ -428,23 +1639,24 @@ class GuildState:
 guild_states: Dict[int, GuildState] = {}
 
 # Глобальный словарь для хранения очередей
-queues: Dict[int, List[Tuple[str, str]]] = {}
+queues: Dict[int, List[Track]] = {}
 
 def get_guild_state(guild_id: int) -> GuildState:
     """Получение состояния для конкретного сервера"""
     if guild_id not in guild_states:
-        guild_states[guild_id] = GuildState()
+        guild_states[guild_id] = GuildState(guild_id)
     return guild_states[guild_id]
 
-def get_best_audio_format(formats: List[dict]) -> Optional[str]:
-    """Находит лучший доступный аудио формат"""
+def select_audio_format(formats: List[dict], target_kbps: Optional[int] = None) -> Optional[str]:
+    """Единый выбор аудио формата с учетом битрейта голосового канала.
+
+    Берется самый легкий формат не ниже target_kbps, Opus в приоритете;
+    если такого нет или битрейт канала неизвестен - самый качественный.
+    """
     if not formats:
         return None
-        
-    # Сначала ищем m4a аудио форматы
-    m4a_formats = []
-    audio_formats = []
-    
+
+    candidates = []
     for f in formats:
         if not isinstance(f, dict):
             continue
@@ -452,51 +1664,49 @@ def get_best_audio_format(formats: List[dict]) -> Optional[str]:
         if f.get('acodec') == 'none' or not f.get('url'):
             continue
             
-        format_data = {
-            'url': f['url'],
-            'abr': float(f.get('abr', 0) or 0),
-            'asr': float(f.get('asr', 0) or 0),
-            'filesize': float(f.get('filesize', 0) or 0),
-            'format_id': f.get('format_id', ''),
-            'ext': f.get('ext', ''),
-            'vcodec': f.get('vcodec', ''),
-            'protocol': f.get('protocol', '')
-        }
-        
         # Пропускаем форматы с протоколами dash и hls
-        if 'dash' in format_data['protocol'].lower() or 'hls' in format_data['protocol'].lower():
+        protocol = (f.get('protocol') or '').lower()
+        if 'dash' in protocol or 'hls' in protocol or 'm3u8' in protocol:
             continue
             
-        # Пропускаем форматы без аудио или с проблемными кодеками
-        if not format_data['abr'] and not format_data['asr']:
+        # Получаем битрейт, проверяем что это число
+        try:
+            abr = float(f.get('abr', 0) or f.get('tbr', 0) or 0)
+        except (ValueError, TypeError):
             continue
             
-        if format_data['ext'] == 'm4a':
-            m4a_formats.append(format_data)
-        else:
-            audio_formats.append(format_data)
-    
-    # Сортируем форматы по приоритету
-    if m4a_formats:
-        m4a_formats.sort(key=lambda x: (x['abr'], -x['filesize']), reverse=True)
-        return m4a_formats[0]['url']
-    
-    if audio_formats:
-        audio_formats.sort(key=lambda x: (x['abr'], -x['filesize']), reverse=True)
-        return audio_formats[0]['url']
-    
-    # Если не нашли аудио форматы, ищем любые форматы с URL и аудио
-    for f in formats:
-        if not isinstance(f, dict):
+        if not abr:
             continue
             
-        if f.get('url') and f.get('acodec') != 'none':
-            return f['url']
+        candidates.append({
+            'url': f['url'],
+            'abr': abr,
+            'audio_only': f.get('vcodec') in (None, 'none'),
+            'opus': (f.get('acodec') or '').startswith('opus'),
+            'filesize': float(f.get('filesize', 0) or 0)
+        })
     
-    return None
+    if not candidates:
+        # Если не нашли аудио форматы, ищем любые форматы с URL и аудио
+        for f in formats:
+            if isinstance(f, dict) and f.get('url') and f.get('acodec') != 'none':
+                return f['url']
+        return None
+
+    # Форматы без видео не тянут лишние данные
+    audio_only = [f for f in candidates if f['audio_only']]
+    if audio_only:
+        candidates = audio_only
+
+    if target_kbps:
+        sufficient = [f for f in candidates if f['abr'] >= target_kbps]
+        if sufficient:
+            return min(sufficient, key=lambda f: (not f['opus'], f['abr']))['url']
+
+    return max(candidates, key=lambda f: (f['abr'], f['opus'], -f['filesize']))['url']
 
 @lru_cache(maxsize=100)
-def extract_audio_info(url: str, process_playlist: bool = False) -> Union[Tuple[str, str], List[Tuple[str, str]]]:
+def extract_audio_info(url: str, process_playlist: bool = False) -> Union[Track, List[dict]]:
     """Извлекает информацию о видео или плейлисте с YouTube с кэшированием"""
     cache_key = f"{url}_{process_playlist}"
     current_time = time.time()
@@ -517,17 +1727,9 @@ def extract_audio_info(url: str, process_playlist: bool = False) -> Union[Tuple[
 
         ydl_opts = YDL_OPTIONS.copy()
         if process_playlist:
-            ydl_opts.update({
-                'extract_flat': 'in_playlist',
-                'playlistend': 50,
-                'playlistreverse': False,
-                'playlist_items': '1-50',
-                'ignoreerrors': True,
-                'no_warnings': True,
-                'quiet': True
-            })
-        
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            ydl_opts.update(PLAYLIST_YDL_OPTIONS)
+        
+        with create_ydl(ydl_opts) as ydl:
             try:
                 # Получаем базовую информацию
                 info = ydl.extract_info(url, download=False)
@@ -540,86 +1742,8 @@ def extract_audio_info(url: str, process_playlist: bool = False) -> Union[Tuple[
                     if not entries:
                         raise YouTubeAccessError("Плейлист пуст или недоступен")
                     
-                    # Фильтруем и обрабатываем записи плейлиста
-                    playlist_entries = []
-                    for entry in entries:
-                        if not entry:
-                            continue
-                            
-                        try:
-                            # Пропускаем приватные и недоступные видео
-                            if entry.get('availability') in ['private', 'needs_auth']:
-                                continue
-                                
-                            # Получаем информацию о каждом видео отдельно
-                            video_url = entry.get('url') or entry.get('webpage_url')
-                            if not video_url and entry.get('id'):
-                                video_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                                
-                            if not video_url:
-                                continue
-                                
-                            try:
-                                video_info = ydl.extract_info(video_url, download=False)
-                                if not video_info:
-                                    continue
-                                    
-                                # Проверяем ограничения
-                                if video_info.get('is_live') or video_info.get('was_live'):
-                                    continue
-                                    
-                                if video_info.get('duration', 0) > 7200:  # 2 часа
-                                    continue
-                                
-                                # Получаем URL аудио
-                                formats = video_info.get('formats', [])
-                                if not formats:
-                                    continue
-                                    
-                                audio_formats = []
-                                for f in formats:
-                                    if not isinstance(f, dict):
-                                        continue
-                                        
-                                    if f.get('acodec') == 'none' or not f.get('url'):
-                                        continue
-                                        
-                                    # Получаем битрейт, проверяем что это число
-                                    try:
-                                        abr = float(f.get('abr', 0) or f.get('tbr', 0) or 0)
-                                    except (ValueError, TypeError):
-                                        continue
-                                        
-                                    if not abr:
-                                        continue
-                                        
-                                    audio_formats.append({
-                                        'url': f['url'],
-                                        'abr': abr,
-                                        'ext': f.get('ext', ''),
-                                        'protocol': f.get('protocol', '').lower()
-                                    })
-                                
-                                if not audio_formats:
-                                    continue
-                                
-                                # Сортируем по битрейту
-                                audio_formats.sort(key=lambda x: x['abr'], reverse=True)
-                                audio_url = audio_formats[0]['url']
-                                
-                                # Получаем название
-                                title = video_info.get('title', entry.get('title', 'Без названия'))
-                                if not title or title == 'Без названия':
-                                    title = video_info.get('fulltitle', video_info.get('alt_title', 'Без названия'))
-                                
-                                playlist_entries.append((audio_url, title))
-                                
-                            except youtube_dl.utils.DownloadError:
-                                continue
-                            
-                        except Exception as e:
-                            logger.warning(f"Пропуск трека в плейлисте: {str(e)}")
-                            continue
+                    # Сохраняем только id и названия, треки извлекаются перед воспроизведением
+                    playlist_entries = compact_playlist_entries(entries)
                     
                     if not playlist_entries:
                         raise YouTubeAccessError("В плейлисте нет доступных треков")
@@ -650,7 +1774,7 @@ def extract_audio_info(url: str, process_playlist: bool = False) -> Union[Tuple[
         logger.error(f"Ошибка извлечения аудио: {str(e)}")
         raise YouTubeAccessError(f"Неизвестная ошибка: {str(e)}")
 
-def process_single_video(info: dict, ydl: youtube_dl.YoutubeDL) -> Tuple[str, str]:
+def process_single_video(info: dict, ydl: 'youtube_dl.YoutubeDL', target_bitrate: Optional[int] = None) -> Track:
     """Обрабатывает одиночное видео"""
     try:
         # Проверяем ограничения
@@ -673,54 +1797,106 @@ def process_single_video(info: dict, ydl: youtube_dl.YoutubeDL) -> Tuple[str, st
         if not formats:
             raise YouTubeAccessError("Не удалось получить форматы видео")
             
-        # Ищем лучший аудио формат
-        audio_formats = []
-        for f in formats:
-            if not isinstance(f, dict):
-                continue
-                
-            if f.get('acodec') == 'none' or not f.get('url'):
-                continue
-                
-            # Получаем битрейт, проверяем что это число
-            try:
-                abr = float(f.get('abr', 0) or f.get('tbr', 0) or 0)
-            except (ValueError, TypeError):
-                continue
-                
-            if not abr:
-                continue
-                
-            audio_formats.append({
-                'url': f['url'],
-                'abr': abr,
-                'ext': f.get('ext', ''),
-                'protocol': f.get('protocol', '').lower()
-            })
-        
-        if not audio_formats:
+        # Ищем подходящий аудио формат
+        audio_url = select_audio_format(formats, target_bitrate)
+        if not audio_url:
             raise YouTubeAccessError("Не найдены аудио форматы")
         
-        # Сортируем по битрейту и выбираем лучший
-        audio_formats.sort(key=lambda x: x['abr'], reverse=True)
-        audio_url = audio_formats[0]['url']
-        
         # Получаем название
         title = video_info.get('title', 'Без названия')
         if not title or title == 'Без названия':
             title = video_info.get('fulltitle', video_info.get('alt_title', 'Без названия'))
 
-        return (audio_url, title)
+        return Track(audio_url, title, video_info.get('duration') or 0, video_info.get('id'))
         
     except Exception as e:
         logger.error(f"Ошибка обработки видео: {str(e)}")
         raise YouTubeAccessError(f"Ошибка обработки видео: {str(e)}")
 
-async def process_playlist_entry(entry: dict) -> Optional[Tuple[str, str]]:
+SKIP_ENTRY = object()  # Трек не подходит (стрим или слишком длинный), повторять не нужно
+
+def resolve_playlist_entry_sync(url: str, ydl_opts: dict, entry: dict, target_bitrate: Optional[int] = None):
+    """Полностью извлекает трек из плейлиста (выполняется в отдельном потоке)"""
+    with create_ydl(ydl_opts) as ydl:
+        # Сначала получаем базовую информацию
+        info = ydl.extract_info(url, download=False, process=False)
+        if not info:
+            return None
+        
+        # Проверяем базовые ограничения
+        if info.get('is_live') or info.get('was_live'):
+            logger.warning(f"Пропускаем трек {entry['title']}: это прямая трансляция")
+            return SKIP_ENTRY
+            
+        if info.get('duration', 0) > 7200:
+            logger.warning(f"Пропускаем трек {entry['title']}: слишком длинный")
+            return SKIP_ENTRY
+        
+        # Получаем полную информацию
+        video_info = ydl.extract_info(url, download=False)
+        if not video_info:
+            return None
+        
+        # Получаем URL аудио
+        audio_url = select_audio_format(video_info.get('formats', []), target_bitrate)
+        if not audio_url:
+            return None
+        
+        # Получаем название
+        title = video_info.get('title', entry.get('title', 'Без названия'))
+        if not title or title == 'Без названия':
+            title = video_info.get('fulltitle', video_info.get('alt_title', 'Без названия'))
+        
+        return Track(audio_url, title, video_info.get('duration') or 0, video_info.get('id') or entry.get('id'))
+
+def enumerate_playlist_sync(url: str, ydl_opts: dict) -> Tuple[Optional[List[dict]], Optional[dict]]:
+    """Постранично перечисляет плейлист без извлечения потоков (выполняется в отдельном потоке).
+
+    Возвращает (записи, None) для плейлиста и (None, info), если по ссылке одиночное
+    видео: его ответ уже получен, и повторно извлекать ссылку не нужно.
+    """
+    with create_ydl(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        # Ссылка вида watch?v=...&list=... сначала ведет на сам плейлист
+        while info and info.get('_type') in ('url', 'url_transparent') and info.get('url') != url:
+            url = info['url']
+            info = ydl.extract_info(url, download=False, process=False, ie_key=info.get('ie_key'))
+        if not info or 'entries' not in info:
+            is_video = info and info.get('_type', 'video') == 'video' and info.get('formats')
+            return None, info if is_video else None
+        # Записи отдаются генератором: следующие страницы запрашиваются по мере чтения
+        return list(islice(info['entries'] or [], MAX_PLAYLIST_SIZE * 2)), None
+
+def resolve_video_sync(info: dict, ydl_opts: dict) -> dict:
+    """Выбирает форматы для уже извлеченного видео без нового запроса (в потоке пула)"""
+    with create_ydl(ydl_opts) as ydl:
+        return ydl.process_ie_result(info, download=False)
+
+def compact_playlist_entries(entries) -> List[dict]:
+    """Оставляет от плоских записей плейлиста только id, название и длительность"""
+    compact = []
+    for entry in entries:
+        if len(compact) >= MAX_PLAYLIST_SIZE:
+            break
+        if not entry or entry.get('availability') in ['private', 'needs_auth']:
+            continue
+        if not entry.get('id'):
+            continue
+        if (entry.get('duration') or 0) > 7200:  # 2 часа
+            continue
+        compact.append({
+            'id': entry['id'],
+            'title': entry.get('title') or 'Без названия',
+            'duration': entry.get('duration') or 0
+        })
+    return compact
+
+async def process_playlist_entry(entry: dict, target_bitrate: Optional[int] = None, priority: int = PRIORITY_BACKGROUND,
+                                 guild_id: Optional[int] = None) -> Optional[Track]:
     """Обрабатывает отдельную запись из плейлиста с задержкой"""
     try:
         # Проверяем длительность если она доступна
-        if entry.get('duration', 0) > 7200:  # 2 часа
+        if (entry.get('duration') or 0) > 7200:  # 2 часа
             logger.warning(f"Пропускаем трек {entry['title']}: слишком длинный")
             return None
             
@@ -743,7 +1919,7 @@ async def process_playlist_entry(entry: dict) -> Optional[Tuple[str, str]]:
             'no_warnings': True,
             'ignoreerrors': True,
             'no_check_certificate': True,
-            'socket_timeout': 15,
+            'socket_timeout': YDL_SOCKET_TIMEOUT,
             'retries': 3,
             'skip_unavailable_videos': True,
             'http_headers': {
@@ -757,7 +1933,7 @@ async def process_playlist_entry(entry: dict) -> Optional[Tuple[str, str]]:
                     'skip': [],
                     'player_skip': [],
                     'skip_unavailable_videos': True,
-                    'player_client': 'web',
+                    'player_client': ['web'],
                     'player_skip_formats': ['dash', 'hls']
                 }
             }
@@ -769,42 +1945,18 @@ async def process_playlist_entry(entry: dict) -> Optional[Tuple[str, str]]:
         
         while retry_count < max_retries:
             try:
-                with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                    # Сначала получаем базовую информацию
-                    info = ydl.extract_info(url, download=False, process=False)
-                    if not info:
-                        retry_count += 1
-                        await asyncio.sleep(random.uniform(1, 2))
-                        continue
-                    
-                    # Проверяем базовые ограничения
-                    if info.get('is_live') or info.get('was_live'):
-                        logger.warning(f"Пропускаем трек {entry['title']}: это прямая трансляция")
-                        return None
-                        
-                    if info.get('duration', 0) > 7200:
-                        logger.warning(f"Пропускаем трек {entry['title']}: слишком длинный")
-                        return None
-                    
-                    # Получаем полную информацию
-                    video_info = ydl.extract_info(url, download=False)
-                    if not video_info:
-                        retry_count += 1
-                        await asyncio.sleep(random.uniform(1, 2))
-                        continue
-                    
-                    # Получаем URL аудио
-                    audio_url = get_best_audio_format(video_info.get('formats', []))
-                    if not audio_url:
-                        retry_count += 1
-                        continue
-                    
-                    # Получаем название
-                    title = video_info.get('title', entry.get('title', 'Без названия'))
-                    if not title or title == 'Без названия':
-                        title = video_info.get('fulltitle', video_info.get('alt_title', 'Без названия'))
-                    
-                    return (audio_url, title)
+                # Извлечение блокирующее, поэтому выполняется в пуле потоков
+                result = await youtube_client.executor.run(
+                    resolve_playlist_entry_sync, url, ydl_opts, entry, target_bitrate,
+                    priority=priority, tenant=guild_id
+                )
+                if result is SKIP_ENTRY:
+                    return None
+                if result:
+                    return result
+                retry_count += 1
+                await asyncio.sleep(random.uniform(1, 2))
+                continue
                     
             except youtube_dl.utils.DownloadError as e:
                 last_error = e
@@ -835,7 +1987,7 @@ class InteractionContext:
         self.guild_id = interaction.guild_id
         self.channel = interaction.channel
         self.author = interaction.user
-        self._sent_messages = []
+        self._last_message = None  # Храним только последнее сообщение, а не всю историю
         
         # Получаем состояние сервера
         guild_state = get_guild_state(self.guild_id)
@@ -844,23 +1996,19 @@ class InteractionContext:
     async def send(self, content: str, **kwargs):
         """Отправка сообщения через interaction"""
         try:
-            if not self._sent_messages:  # Первое сообщение
-                if not self.interaction.response.is_done():
-                    await self.interaction.response.send_message(content, **kwargs)
-                    message = await self.interaction.original_response()
-                else:
-                    message = await self.channel.send(content, **kwargs)
-                self._sent_messages.append(message)
+            if self._last_message is None and not self.interaction.response.is_done():  # Первое сообщение
+                await self.interaction.response.send_message(content, **kwargs)
+                message = await self.interaction.original_response()
             else:  # Последующие сообщения
                 message = await self.channel.send(content, **kwargs)
-                self._sent_messages.append(message)
-            return self._sent_messages[-1]
+            self._last_message = message
+            return message
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения: {e}")
             # Пробуем отправить через канал если interaction не работает
             try:
                 message = await self.channel.send(content, **kwargs)
-                self._sent_messages.append(message)
+                self._last_message = message
                 return message
             except Exception as e2:
                 logger.error(f"Ошибка отправки сообщения через канал: {e2}")
@@ -907,6 +2055,249 @@ class DisconnectTimer:
 # Глобальный словарь для хранения таймеров отключения
 disconnect_timers = {}
 
+class LoudnessAnalyzer:
+    """Фоновый анализ громкости треков с постоянным кэшем по id видео.
+
+    Один воркер с пониженным приоритетом прогоняет трек через loudnorm
+    и сохраняет интегральную громкость и истинный пик. При воспроизведении
+    к уже измеренным трекам применяется дешевый статический фильтр volume.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._results: Dict[str, Dict[str, float]] = {}
+        self._pending: set = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._results = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш громкости: {e}")
+
+    def _save(self, results: Dict[str, Dict[str, float]]):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        if not self._task:
+            self._queue = asyncio.Queue(maxsize=LOUDNESS_QUEUE_SIZE)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def gain_for(self, video_id: str) -> Optional[float]:
+        """Статическое усиление в дБ или None, если трек еще не измерен"""
+        result = self._results.get(video_id)
+        if not result:
+            return None
+        gain = LOUDNESS_TARGET - result['i']
+        gain = min(gain, LOUDNESS_MAX_TRUE_PEAK - result['tp'])
+        low, high = LOUDNESS_GAIN_LIMITS
+        return max(low, min(high, gain))
+
+    def will_measure(self, track: Track) -> bool:
+        """Получит ли трек усиление после анализа"""
+        return bool(track.video_id) and 0 < (track.duration or 0) <= LOUDNESS_MAX_DURATION
+
+    def request(self, track: Track):
+        """Ставит трек в очередь на анализ, если он еще не измерен"""
+        if not self._queue or not track.video_id:
+            return
+        if track.video_id in self._results or track.video_id in self._pending:
+            return
+        if not track.duration or track.duration > LOUDNESS_MAX_DURATION:
+            return
+        try:
+            self._queue.put_nowait(track)
+            self._pending.add(track.video_id)
+        except asyncio.QueueFull:
+            pass
+
+    async def _run(self):
+        while True:
+            track = await self._queue.get()
+            try:
+                result = await self._analyze(track.url)
+                if result:
+                    self._results[track.video_id] = result
+                    snapshot = dict(self._results)
+                    await disk_pool.run(self._save, snapshot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка анализа громкости {track.title}: {e}")
+            finally:
+                self._pending.discard(track.video_id)
+
+    async def _analyze(self, url: str) -> Optional[Dict[str, float]]:
+        """Измеряет громкость трека через ffmpeg loudnorm"""
+        if sys.platform == 'win32':
+            priority = {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+        else:
+            priority = {'preexec_fn': lambda: os.nice(10)}
+
+        # Параметры переподключения есть только у сетевых протоколов
+        reconnect = ['-reconnect', '1', '-reconnect_streamed', '1'] if url.startswith(('http://', 'https://')) else []
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-nostats', *reconnect,
+            '-i', url, '-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            **priority
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+
+        output = stderr.decode('utf-8', errors='ignore')
+        start = output.rfind('{')
+        if process.returncode != 0 or start == -1:
+            return None
+        data = json.loads(output[start:output.rfind('}') + 1])
+        integrated, true_peak = float(data['input_i']), float(data['input_tp'])
+        if integrated == float('-inf'):
+            return None  # Тишина
+        return {'i': integrated, 'tp': true_peak}
+
+loudness_analyzer = LoudnessAnalyzer(LOUDNESS_CACHE_FILE)
+
+class BroadcastStation:
+    """Радио: один ffmpeg кодирует Opus один раз, пакеты раздаются всем слушателям.
+
+    Поток-производитель читает пакеты в реальном темпе (20 мс) и кладет их
+    в кольцевой буфер с абсолютными номерами. Каждый слушатель хранит свой
+    курсор, поэтому подключиться можно в любой момент, а отставший слушатель
+    перескакивает на самый старый пакет в буфере.
+    """
+    def __init__(self, name: str, track: Track, guild_id: int):
+        self.name = name
+        self.track = track
+        self.guild_id = guild_id  # Сервер, запустивший станцию
+        self.started_at = time.time()
+        self.finished = False
+        self.listeners: set = set()  # id серверов-слушателей
+        self._packets = deque(maxlen=BROADCAST_BUFFER_PACKETS)
+        self._base = 0  # Номер самого старого пакета в буфере
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._source = None
+        self._thread = None
+
+    @property
+    def head(self) -> int:
+        """Номер следующего пакета, который будет записан"""
+        return self._base + len(self._packets)
+
+    def start(self):
+        """Запускает ffmpeg и поток-производитель; Popen блокирует, вызывать в spawn_pool"""
+        self._source = discord.FFmpegOpusAudio(
+            self.track.url,
+            bitrate=BROADCAST_BITRATE,
+            before_options=FFMPEG_OPTIONS['before_options'],
+            options=FFMPEG_OPTIONS['options']
+        )
+        self._thread = threading.Thread(target=self._produce, name=f"radio-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _produce(self):
+        next_time = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                packet = self._source.read()
+                if not packet:
+                    break
+                with self._cond:
+                    if len(self._packets) == self._packets.maxlen:
+                        self._base += 1
+                    self._packets.append(packet)
+                    self._cond.notify_all()
+                next_time += FRAME_DURATION
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            logger.error(f"Ошибка трансляции {self.name}: {e}")
+        finally:
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+            self._source.cleanup()
+
+    def read_from(self, cursor: int) -> Tuple[bytes, int]:
+        """Возвращает пакет по курсору слушателя и новый курсор"""
+        with self._cond:
+            if cursor < self._base:
+                cursor = self._base  # Слушатель отстал больше, чем хранит буфер
+            if cursor >= self.head and not self.finished:
+                self._cond.wait(FRAME_DURATION * 2)
+            if cursor < self.head:
+                return self._packets[cursor - self._base], cursor + 1
+            if self.finished:
+                return b'', cursor
+            return OPUS_SILENCE, cursor
+
+    def subscribe(self, guild_id: int) -> 'BroadcastSubscriber':
+        with self._cond:
+            cursor = max(self._base, self.head - BROADCAST_JOIN_DELAY_PACKETS)
+        self.listeners.add(guild_id)
+        return BroadcastSubscriber(self, guild_id, cursor)
+
+class BroadcastSubscriber(discord.AudioSource):
+    """Источник для VoiceClient, читающий уже закодированные пакеты станции"""
+    def __init__(self, station: BroadcastStation, guild_id: int, cursor: int):
+        self.station = station
+        self.guild_id = guild_id
+        self._cursor = cursor
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        packet, self._cursor = self.station.read_from(self._cursor)
+        return packet
+
+    def cleanup(self):
+        self.station.listeners.discard(self.guild_id)
+
+# Активные радиостанции по имени
+broadcast_stations: Dict[str, BroadcastStation] = {}
+
+def loudness_gain(track: Track) -> Optional[float]:
+    """Статическое усиление трека; неизмеренный трек ставится в очередь анализа (в цикле событий)"""
+    if not NORMALIZE_VOLUME or not track.video_id:
+        return None
+    gain = loudness_analyzer.gain_for(track.video_id)
+    if gain is None:
+        loudness_analyzer.request(track)
+    return gain
+
+def ffmpeg_options_for(track: Track, gain: Optional[float] = None) -> dict:
+    """Параметры ffmpeg для трека со статическим усилением, если громкость известна"""
+    is_local = bool(track.video_id and track.video_id.startswith(LOCAL_PREFIX))
+    options = dict(LOCAL_FFMPEG_OPTIONS if is_local else FFMPEG_OPTIONS)
+    if gain is not None:
+        options['options'] = f"{options['options']} -af volume={gain:.2f}dB"
+    return options
+
 async def kill_ffmpeg_process(process):
     """Принудительно завершает процесс ffmpeg"""
     try:
@@ -922,17 +2313,28 @@ async def kill_ffmpeg_process(process):
 class FFmpegAudio(discord.FFmpegPCMAudio):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._process = None
+        # self._process уже создан в discord.FFmpegAudio, не затираем его
         self._start_time = None
         self._retry_count = 0
+        self.frames_read = 0  # Количество отданных 20 мс кадров
+
+    def read(self) -> bytes:
+        data = super().read()
+        if data:
+            self.frames_read += 1
+        return data
+
+    @property
+    def position(self) -> float:
+        """Текущая позиция воспроизведения в секундах по числу кадров"""
+        return self.frames_read * FRAME_DURATION
         
     async def _start_ffmpeg(self):
         """Запускает ffmpeg процесс с таймаутом и повторными попытками"""
         while self._retry_count < MAX_RETRIES:
             try:
                 self._process = await asyncio.wait_for(
-                    asyncio.get_event_loop().run_in_executor(
-                        None,
+                    spawn_pool.run(
                         lambda: subprocess.Popen(
                             self._cmd,
                             stdout=subprocess.PIPE,
@@ -961,11 +2363,796 @@ class FFmpegAudio(discord.FFmpegPCMAudio):
     def cleanup(self):
         """Улучшенная очистка ресурсов"""
         try:
-            if self._process:
-                asyncio.create_task(kill_ffmpeg_process(self._process))
+            # Вызывается из потока плеера: discord.py сам завершает и дожидается ffmpeg
+            super().cleanup()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке ffmpeg: {e}")
+
+class TeeReader:
+    """Читает поток и одновременно пишет прочитанные байты в файл"""
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        if data and self.sink:
+            try:
+                self.sink.write(data)
+            except OSError as e:
+                logger.warning(f"Ошибка записи в кэш Opus: {e}")
+                self.sink = None
+        return data
+
+class CachingOpusAudio(discord.FFmpegOpusAudio):
+    """Первое воспроизведение трека: Ogg-страницы от ffmpeg идут в голосовой клиент и в кэш"""
+    def __init__(self, track: Track, cache: 'OpusCache', gain: Optional[float] = None, **kwargs):
+        super().__init__(track.url, bitrate=OPUS_CACHE_BITRATE, **kwargs)
+        self.track = track
+        self.frames_read = 0
+        self._cache = cache
+        self._gain = gain  # Усиление уже в записи, повтор ищется по нему
+        self._writer = cache.begin(track, gain)
+        self._reached_end = False
+        if self._writer:
+            self._packet_iter = OggStream(TeeReader(self._stdout, self._writer)).iter_packets()
+
+    def read(self) -> bytes:
+        data = next(self._packet_iter, b'')
+        if data:
+            self.frames_read += 1
+        else:
+            self._reached_end = True
+        return data
+
+    @property
+    def position(self) -> float:
+        return self.frames_read * FRAME_DURATION
+
+    def cleanup(self):
+        try:
             super().cleanup()
         except Exception as e:
             logger.error(f"Ошибка при очистке ffmpeg: {e}")
+        if self._writer:
+            # Пропущенный или оборвавшийся трек в кэш не попадает
+            complete = self._reached_end and self.position >= self.track.duration * OPUS_CACHE_COMPLETE_RATIO
+            self._cache.finish(self.track, self._gain, self._writer, complete)
+            self._writer = None
+
+class CachedOpusAudio(discord.AudioSource):
+    """Повтор трека из кэша: пакеты читаются из отображенного в память файла, без сети и ffmpeg"""
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._packet_iter = OggStream(self._mmap).iter_packets()
+        self.frames_read = 0
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        try:
+            data = next(self._packet_iter, b'')
+        except (OggError, ValueError) as e:
+            logger.warning(f"Поврежденный файл кэша Opus: {e}")
+            return b''
+        if data:
+            self.frames_read += 1
+        return data
+
+    @property
+    def position(self) -> float:
+        return self.frames_read * FRAME_DURATION
+
+    def cleanup(self):
+        try:
+            self._mmap.close()
+        except Exception:
+            pass
+        self._file.close()
+
+class OpusCache:
+    """Дисковый кэш Ogg Opus по id видео с вытеснением давно не игравших треков по объему.
+
+    Запись хранится вместе с примененным усилением громкости: ключ файла
+    строится из id видео и усиления, поэтому после измерения громкости
+    ненормализованная запись больше не находится и вытесняется как старая.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()  # id видео -> размер, от старых к новым
+        self._writing = set()
+        self._loaded = False
+        self._lock = threading.Lock()  # Запись идет из потоков плеера и пулов
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, video_id: str, gain: Optional[float] = None) -> str:
+        variant = video_id if gain is None else f"{video_id}@{gain:.2f}"
+        name = hashlib.sha1(variant.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, f"{name}.ogg")
+
+    def load(self):
+        """Восстанавливает индекс по файлам каталога, порядок LRU - по mtime (в потоке)"""
+        with self._lock:
+            if self._loaded or not self.enabled:
+                return
+            self._loaded = True
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                files = []
+                with os.scandir(self.directory) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.part'):
+                            os.unlink(entry.path)  # Недописанные файлы прошлого запуска
+                        elif entry.name.endswith('.ogg'):
+                            stat = entry.stat()
+                            files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            except OSError as e:
+                logger.warning(f"Не удалось прочитать каталог кэша Opus: {e}")
+                return
+            # В индексе хранится имя файла: id видео после хэширования не восстановить
+            for _, name, size in sorted(files):
+                self._entries[name] = size
+                self.total_bytes += size
+        self.evict(self.max_bytes)
+
+    def _key(self, video_id: str, gain: Optional[float] = None) -> str:
+        return os.path.basename(self._path(video_id, gain))[:-4]
+
+    def should_cache(self, track: Track) -> bool:
+        return (
+            self.enabled
+            and bool(track.video_id)
+            and not track.video_id.startswith(LOCAL_PREFIX)
+            and 0 < track.duration <= OPUS_CACHE_MAX_DURATION
+        )
+
+    def open(self, track: Track, gain: Optional[float] = None) -> Optional[CachedOpusAudio]:
+        """Источник для повтора из кэша с тем же усилением или None"""
+        if not self.enabled or not track.video_id or track.video_id.startswith(LOCAL_PREFIX):
+            return None  # Локальные файлы не кэшируются и в статистику промахов не идут
+        key = self._key(track.video_id, gain)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self._path(track.video_id, gain)
+        try:
+            os.utime(path)  # Порядок LRU переживает перезапуск
+            return CachedOpusAudio(path)
+        except Exception as e:
+            logger.warning(f"Не удалось открыть кэш Opus {path}: {e}")
+            self._forget(key)
+            return None
+
+    def begin(self, track: Track, gain: Optional[float] = None):
+        """Открывает файл для записи первого воспроизведения или возвращает None"""
+        key = self._key(track.video_id, gain)
+        with self._lock:
+            if key in self._entries or key in self._writing:
+                return None
+            self._writing.add(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            return open(self._path(track.video_id, gain) + '.part', 'wb')
+        except OSError as e:
+            logger.warning(f"Не удалось создать файл кэша Opus: {e}")
+            with self._lock:
+                self._writing.discard(key)
+            return None
+
+    def finish(self, track: Track, gain: Optional[float], writer, complete: bool):
+        """Закрывает файл записи и добавляет его в кэш, если трек проигран целиком"""
+        key = self._key(track.video_id, gain)
+        path = self._path(track.video_id, gain)
+        try:
+            writer.close()
+            if complete:
+                os.replace(path + '.part', path)
+                size = os.path.getsize(path)
+                with self._lock:
+                    self._entries[key] = size
+                    self.total_bytes += size
+            else:
+                os.unlink(path + '.part')
+        except OSError as e:
+            logger.warning(f"Ошибка сохранения кэша Opus: {e}")
+        finally:
+            with self._lock:
+                self._writing.discard(key)
+        if complete:
+            self.evict(self.max_bytes)
+
+    def _forget(self, key: str):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def evict(self, target_bytes: int) -> int:
+        """Удаляет самые давние треки, пока кэш больше target_bytes; возвращает освобожденные байты"""
+        if not self._loaded:
+            self.load()
+        freed = 0
+        while True:
+            with self._lock:
+                if self.total_bytes <= target_bytes or not self._entries:
+                    break
+                key, size = self._entries.popitem(last=False)
+                self.total_bytes -= size
+            try:
+                os.unlink(os.path.join(self.directory, f"{key}.ogg"))
+                freed += size
+            except OSError as e:
+                # На Windows файл, открытый для повтора, удалить нельзя
+                logger.debug(f"Не удалось удалить файл кэша Opus {key}: {e}")
+        return freed
+
+    def summary(self) -> str:
+        return (
+            f"{len(self._entries)} треков, {self.total_bytes / 2**20:.0f}/{self.max_bytes / 2**20:.0f} МБ, "
+            f"попаданий {self.hits}, промахов {self.misses}"
+        )
+
+opus_cache = OpusCache(OPUS_CACHE_DIR, OPUS_CACHE_MAX_MB * 2**20)
+
+def create_audio_source(track: Track, options: dict, gain: Optional[float] = None) -> discord.AudioSource:
+    """Источник звука: повтор из кэша Opus, запись в кэш при первом проигрывании или обычный ffmpeg"""
+    cached = opus_cache.open(track, gain)
+    if cached:
+        return cached
+    # Пока громкость не измерена, запись не кэшируется: ее повторы остались бы без нормализации
+    awaiting_gain = NORMALIZE_VOLUME and gain is None and loudness_analyzer.will_measure(track)
+    if opus_cache.should_cache(track) and not awaiting_gain:
+        return CachingOpusAudio(track, opus_cache, gain, **options)
+    return FFmpegAudio(track.url, **options)
+
+class TitleIndex:
+    """Префиксный индекс названий для автодополнения /play.
+
+    Отсортированный массив ключей (название с каждого слова) и бинарный поиск:
+    ответ строится без обращений к сети, а ранжирование учитывает популярность
+    трека на сервере и глобально.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._keys: List[Tuple[str, int]] = []  # (нормализованный ключ, id названия)
+        self._titles: List[Tuple[str, Optional[str]]] = []  # (название, id видео)
+        self._ids: Dict[str, int] = {}
+        self._global: Dict[int, int] = {}
+        self._per_guild: Dict[int, Dict[int, int]] = {}
+        self._dirty = False  # Есть воспроизведения, не записанные на диск
+        self._load()
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    def _add_title(self, title: str, video_id: Optional[str], keys: Optional[list] = None) -> int:
+        """Добавляет название; при массовой загрузке ключи копятся в keys и сортируются один раз"""
+        normalized = self._normalize(title)
+        title_id = self._ids.get(normalized)
+        if title_id is not None:
+            if video_id and not self._titles[title_id][1]:
+                self._titles[title_id] = (title, video_id)
+            return title_id
+
+        title_id = len(self._titles)
+        self._titles.append((title, video_id))
+        self._ids[normalized] = title_id
+        words = normalized.split(" ")
+        for i in range(min(len(words), TITLE_INDEX_MAX_WORDS)):
+            key = (" ".join(words[i:]), title_id)
+            if keys is None:
+                bisect.insort(self._keys, key)
+            else:
+                keys.append(key)
+        return title_id
+
+    def record(self, guild_id: int, track: Track):
+        """Учитывает воспроизведение трека"""
+        if not track.title:
+            return
+        title_id = self._add_title(track.title, track.video_id)
+        self._global[title_id] = self._global.get(title_id, 0) + 1
+        guild_counts = self._per_guild.setdefault(guild_id, {})
+        guild_counts[title_id] = guild_counts.get(title_id, 0) + 1
+        self._dirty = True
+
+    def search(self, guild_id: int, prefix: str, limit: int = 25) -> List[Tuple[str, str]]:
+        """Возвращает (название, значение для /play) по префиксу любого слова"""
+        prefix = self._normalize(prefix)
+        if not prefix:
+            return []
+
+        # Ранжируется весь диапазон префикса: популярный трек может стоять в нем где угодно
+        start = bisect.bisect_left(self._keys, (prefix, -1))
+        end = bisect.bisect_left(self._keys, (prefix + '\U0010ffff', -1), start)
+        candidates = {title_id for _, title_id in self._keys[start:end]}
+
+        guild_counts = self._per_guild.get(guild_id, {})
+        ranked = heapq.nlargest(
+            limit, candidates,
+            key=lambda t: (guild_counts.get(t, 0) * TITLE_INDEX_GUILD_WEIGHT + self._global.get(t, 0))
+        )
+        results = []
+        for title_id in ranked:
+            title, video_id = self._titles[title_id]
+            if video_id and video_id.startswith(LOCAL_PREFIX):
+                value = video_id
+            else:
+                value = f"https://www.youtube.com/watch?v={video_id}" if video_id else title
+            results.append((title, value))
+        return results
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать индекс названий: {e}")
+            return
+        # insort на каждый ключ квадратичен по размеру индекса, поэтому одна сортировка в конце
+        keys = []
+        for title, video_id, count in data.get('titles', []):
+            title_id = self._add_title(title, video_id, keys)
+            self._global[title_id] = count
+        self._keys.extend(keys)
+        self._keys.sort()
+        for guild_id, counts in data.get('guilds', {}).items():
+            self._per_guild[int(guild_id)] = {int(t): c for t, c in counts.items()}
+
+    def snapshot(self) -> Optional[dict]:
+        """Копия данных для записи, если с прошлой записи были воспроизведения (в цикле событий)"""
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return {
+            'titles': [[title, video_id, self._global.get(i, 0)] for i, (title, video_id) in enumerate(self._titles)],
+            'guilds': {str(g): dict(counts) for g, counts in self._per_guild.items()}
+        }
+
+    def save(self, data: Optional[dict] = None):
+        """Записывает снимок на диск; без аргумента снимок берется сразу"""
+        data = data or self.snapshot()
+        if not data:
+            return
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self._dirty = True  # Повторим при следующей записи
+            logger.error(f"Ошибка сохранения индекса названий: {e}")
+
+title_index = TitleIndex(TITLE_INDEX_FILE)
+
+def read_audio_tags(path: str, mutagen=None) -> Tuple[str, str, float]:
+    """Название, исполнитель и длительность файла; без mutagen - из имени файла"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    artist, _, title = stem.partition(' - ')
+    if not title:
+        artist, title = '', stem
+    duration = 0.0
+
+    if mutagen:
+        try:
+            audio = mutagen.File(path, easy=True)
+            if audio is not None:
+                tags = audio.tags or {}
+                title = (tags.get('title') or [title])[0]
+                artist = (tags.get('artist') or [artist])[0]
+                duration = float(getattr(audio.info, 'length', 0) or 0)
+        except Exception as e:
+            logger.debug(f"Не удалось прочитать теги {path}: {e}")
+    return title.strip(), artist.strip(), duration
+
+class LocalLibrary:
+    """Локальная музыкальная библиотека с индексом тегов.
+
+    Сканирование инкрементальное: теги читаются только у файлов с новым mtime
+    или размером. Индекс хранится построчно в JSON Lines, поиск - бинарный по
+    отсортированным ключам (название и исполнитель с каждого слова). Все
+    сканирование и построение индекса идет в отдельном потоке, цикл событий
+    получает готовые структуры одним присваиванием.
+    """
+    def __init__(self, roots: List[str], path: str):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.path = path
+        self.scanned_at = 0.0
+        self.scan_seconds = 0.0
+        self._files: Dict[str, list] = {}  # путь -> [mtime_ns, размер, название, исполнитель, длительность]
+        self._by_id: Dict[str, str] = {}  # id файла -> путь
+        self._keys: List[Tuple[str, str]] = []  # (нормализованный ключ, id файла)
+        self.pool = WorkPool('library-scan', 1)
+        self._task = None
+        self._rescan = asyncio.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.roots)
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def start(self):
+        if self.enabled and not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def request_rescan(self):
+        self._rescan.set()
+
+    @staticmethod
+    def file_id(path: str) -> str:
+        return hashlib.sha1(path.encode('utf-8', errors='surrogateescape')).hexdigest()[:16]
+
+    @staticmethod
+    def display_title(title: str, artist: str) -> str:
+        return f"{artist} - {title}" if artist else title
+
+    def track_for(self, file_id: str) -> Optional[Track]:
+        path = self._by_id.get(file_id)
+        if not path:
+            return None
+        _, _, title, artist, duration = self._files[path]
+        return Track(path, self.display_title(title, artist), duration, LOCAL_PREFIX + file_id)
+
+    def search(self, query: str, limit: int = 25) -> List[Tuple[str, str]]:
+        """Возвращает (название, значение для /play) по префиксу любого слова названия или исполнителя"""
+        prefix = TitleIndex._normalize(query)
+        if not prefix:
+            return []
+        keys, by_id, files = self._keys, self._by_id, self._files  # Снимок на случай замены индекса
+
+        found: Dict[str, None] = {}
+        start = bisect.bisect_left(keys, (prefix, ''))
+        for key, file_id in keys[start:start + TITLE_INDEX_SCAN_LIMIT]:
+            if not key.startswith(prefix):
+                break
+            found[file_id] = None
+            if len(found) >= limit:
+                break
+
+        results = []
+        for file_id in found:
+            _, _, title, artist, _ = files[by_id[file_id]]
+            results.append((self.display_title(title, artist), LOCAL_PREFIX + file_id))
+        return results
+
+    def resolve(self, query: str) -> Optional[Track]:
+        """Трек по запросу local:<id> или local:<название>"""
+        query = query[len(LOCAL_PREFIX):].strip() if query.startswith(LOCAL_PREFIX) else query
+        track = self.track_for(query)
+        if track:
+            return track
+        hits = self.search(query, limit=1)
+        return self.track_for(hits[0][1][len(LOCAL_PREFIX):]) if hits else None
+
+    async def _run(self):
+        try:
+            await self._scan()
+            while True:
+                try:
+                    await asyncio.wait_for(self._rescan.wait(), timeout=LIBRARY_RESCAN_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._rescan.clear()
+                await self._scan()
+        except asyncio.CancelledError:
+            pass
+
+    async def _scan(self):
+        try:
+            started = time.perf_counter()
+            first = not self._files
+            files, by_id, keys, changed, removed = await self.pool.run(self._scan_sync, first)
+            # Замена одним шагом: читатели видят либо старый, либо новый индекс
+            self._files, self._by_id, self._keys = files, by_id, keys
+            self.scanned_at = time.time()
+            self.scan_seconds = time.perf_counter() - started
+            logger.info(
+                f"Библиотека просканирована за {self.scan_seconds:.1f} с: "
+                f"{len(files)} файлов, изменено {changed}, удалено {removed}"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка сканирования библиотеки: {e}")
+
+    def _scan_sync(self, load_index: bool):
+        """Обход каталогов, чтение тегов измененных файлов и сборка индекса (в потоке)"""
+        try:
+            import mutagen
+        except ImportError:
+            mutagen = None
+
+        old = self._load() if load_index else self._files
+        files: Dict[str, list] = {}
+        changed = 0
+        stack = list(self.roots)
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                continue
+                            if os.path.splitext(entry.name)[1].lower() not in LIBRARY_EXTENSIONS:
+                                continue
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        record = old.get(entry.path)
+                        if record and record[0] == stat.st_mtime_ns and record[1] == stat.st_size:
+                            files[entry.path] = record
+                            continue
+                        title, artist, duration = read_audio_tags(entry.path, mutagen)
+                        files[entry.path] = [stat.st_mtime_ns, stat.st_size, title, artist, duration]
+                        changed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось прочитать каталог {directory}: {e}")
+
+        removed = len(old.keys() - files.keys())
+        by_id = {self.file_id(path): path for path in files}
+        keys = self._build_keys(files, by_id)
+        if changed or removed:
+            self._save(files)
+        return files, by_id, keys, changed, removed
+
+    @staticmethod
+    def _build_keys(files: Dict[str, list], by_id: Dict[str, str]) -> List[Tuple[str, str]]:
+        runs, chunk = [], []
+        for file_id, path in by_id.items():
+            _, _, title, artist, _ = files[path]
+            for text in (LocalLibrary.display_title(title, artist), title):
+                words = TitleIndex._normalize(text).split(" ")
+                for i in range(min(len(words), TITLE_INDEX_MAX_WORDS)):
+                    chunk.append((" ".join(words[i:]), file_id))
+            if len(chunk) >= LIBRARY_SORT_CHUNK:
+                chunk.sort()
+                runs.append(chunk)
+                chunk = []
+        chunk.sort()
+        runs.append(chunk)
+        # Один list.sort() по всем ключам - это один вызов C, который держит GIL до конца
+        # сортировки. Сортировка кусками и слияние в цикле байткода дают интерпретатору
+        # переключаться на поток цикла событий между кусками и между элементами слияния
+        keys = []
+        for key in heapq.merge(*runs):
+            if not keys or keys[-1] != key:
+                keys.append(key)
+        return keys
+
+    def _load(self) -> Dict[str, list]:
+        files = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    path, *record = json.loads(line)
+                    files[path] = record
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать индекс библиотеки: {e}")
+        return files
+
+    def _save(self, files: Dict[str, list]):
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for path, record in files.items():
+                    f.write(json.dumps([path, *record], ensure_ascii=False, separators=(',', ':')))
+                    f.write('\n')
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения индекса библиотеки: {e}")
+
+local_library = LocalLibrary(LIBRARY_DIRS, LIBRARY_INDEX_FILE)
+
+def format_duration(seconds: float) -> str:
+    """Форматирует секунды как м:сс или ч:мм:сс"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
+
+def render_now_playing(guild_state: 'GuildState') -> Optional[str]:
+    """Строит текст сообщения о текущем треке с прогрессом"""
+    track = guild_state.current_track
+    if not track:
+        return None
+
+    voice_client = guild_state.voice_client
+    source = voice_client.source if voice_client else None
+    position = getattr(source, 'position', 0.0)
+    paused = bool(voice_client and voice_client.is_paused())
+    icon = "⏸️ На паузе" if paused else "▶️ Сейчас играет"
+
+    if not track.duration:
+        return f"{icon}: {track.title}\n`{format_duration(position)}`"
+
+    position = min(position, track.duration)
+    filled = int(position / track.duration * PROGRESS_BAR_LENGTH)
+    bar = "▬" * filled + "🔘" + "▬" * (PROGRESS_BAR_LENGTH - filled)
+    remaining = track.duration - position
+    return (
+        f"{icon}: {track.title}\n"
+        f"{bar} `{format_duration(position)} / {format_duration(track.duration)}` "
+        f"(осталось {format_duration(remaining)})"
+    )
+
+class RouteRateLimiter:
+    """Скользящее окно на каждый маршрут (канал) Discord API"""
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._hits: Dict[int, deque] = {}
+
+    def try_acquire(self, route: int) -> bool:
+        now = time.monotonic()
+        hits = self._hits.setdefault(route, deque())
+        while hits and now - hits[0] >= self.period:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            return False
+        hits.append(now)
+        return True
+
+    def forget(self, route: int):
+        self._hits.pop(route, None)
+
+class NowPlayingUpdater:
+    """Один фоновый цикл, который обновляет прогресс во всех серверах.
+
+    Правки объединяются: за проход отправляется только актуальное состояние,
+    неизменившийся текст не отправляется, интервал растет для длинных треков
+    и серверов без активности, а каждый канал ограничен своим лимитом.
+    """
+    def __init__(self):
+        self._due: Dict[int, float] = {}
+        self._last_content: Dict[int, str] = {}
+        self._limiter = RouteRateLimiter(NOW_PLAYING_CHANNEL_EDITS, NOW_PLAYING_CHANNEL_PERIOD)
+        self._task = None
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def watch(self, guild_id: int, content: str):
+        """Начинает следить за сообщением сервера после его отправки"""
+        self._last_content[guild_id] = content
+        self._due[guild_id] = time.monotonic() + NOW_PLAYING_INTERVAL
+
+    def poke(self, guild_id: int):
+        """Просит обновить сообщение на ближайшем проходе (например, после паузы)"""
+        if guild_id in self._due:
+            self._due[guild_id] = time.monotonic()
+
+    def unwatch(self, guild_id: int):
+        self._due.pop(guild_id, None)
+        self._last_content.pop(guild_id, None)
+
+    def _interval(self, guild_state: 'GuildState') -> float:
+        """Адаптивный интервал обновления для сервера"""
+        interval = NOW_PLAYING_INTERVAL
+        track = guild_state.current_track
+        if track and track.duration > 600:
+            interval *= 2
+        if time.time() - guild_state.last_activity > NOW_PLAYING_IDLE_AFTER:
+            interval *= 3
+        return interval
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(1)
+                await self._tick()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Ошибка обновления сообщений о текущем треке: {e}")
+
+    async def _tick(self):
+        now = time.monotonic()
+        due = [guild_id for guild_id, at in self._due.items() if at <= now]
+        due.sort(key=self._due.get)
+
+        edits = []
+        for guild_id in due:
+            if len(edits) >= NOW_PLAYING_EDITS_PER_TICK:
+                break
+
+            guild_state = guild_states.get(guild_id)
+            message = guild_state.now_playing_message if guild_state else None
+            content = render_now_playing(guild_state) if message else None
+            if content is None:
+                self.unwatch(guild_id)
+                continue
+
+            self._due[guild_id] = now + self._interval(guild_state)
+            if content == self._last_content.get(guild_id):
+                continue
+            if not self._limiter.try_acquire(message.channel.id):
+                # Канал исчерпал лимит - попробуем на следующем проходе
+                self._due[guild_id] = now + 1
+                continue
+
+            self._last_content[guild_id] = content
+            edits.append(self._edit(guild_id, message, content))
+
+        if edits:
+            await asyncio.gather(*edits)
+
+    async def _edit(self, guild_id: int, message: discord.Message, content: str):
+        try:
+            await message.edit(content=content)
+        except discord.NotFound:
+            self.unwatch(guild_id)
+        except discord.HTTPException as e:
+            logger.warning(f"Не удалось обновить прогресс трека: {e}")
+
+now_playing_updater = NowPlayingUpdater()
+
+async def show_now_playing(ctx, guild_state: 'GuildState', content: str) -> Optional[discord.Message]:
+    """Показывает текущий трек, редактируя единственное сообщение сервера"""
+    content = render_now_playing(guild_state) or content
+    message = guild_state.now_playing_message
+    if message and message.channel.id == ctx.channel.id:
+        try:
+            await message.edit(content=content, view=bot.control_view)
+            now_playing_updater.watch(ctx.guild.id, content)
+            return message
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            logger.warning(f"Не удалось обновить сообщение о текущем треке: {e}")
+
+    try:
+        message = await ctx.channel.send(content, view=bot.control_view)
+    except Exception as e:
+        logger.error(f"Ошибка отправки сообщения о текущем треке: {e}")
+        return None
+    guild_state.now_playing_message = message
+    now_playing_updater.watch(ctx.guild.id, content)
+    return message
 
 async def play_next(ctx):
     """Воспроизводит следующий трек из очереди"""
@@ -1000,24 +3187,23 @@ async def play_next(ctx):
         
         # Воспроизводим трек с таймаутом
         try:
-            audio_url, title = next_track
-            guild_state.current_track = (audio_url, title)
+            title = next_track.title
+            guild_state.current_track = next_track
+            title_index.record(ctx.guild.id, next_track)
             guild_state.is_playing = True
             
-            # Создаем таймер для принудительного пропуска трека
-            skip_timer = None
+            playback = guild_state.playback
+            generation = playback.begin_track(ctx)
             
             def after_callback(error):
-                if error:
-                    logger.error(f"Ошибка воспроизведения: {error}")
-                if skip_timer and not skip_timer.done():
-                    skip_timer.cancel()
-                asyncio.run_coroutine_threadsafe(
-                    handle_song_complete(ctx, error), bot.loop
-                ).result()
+                # Поток плеера только публикует событие и сразу возвращается
+                playback.track_finished(generation, error)
             
             # Создаем аудио источник с улучшенной обработкой
-            audio_source = FFmpegAudio(audio_url, **FFMPEG_OPTIONS)
+            # Popen и mmap блокируют, поэтому источник создается в своем пуле
+            gain = loudness_gain(next_track)
+            options = ffmpeg_options_for(next_track, gain)
+            audio_source = await spawn_pool.run(create_audio_source, next_track, options, gain)
             
             # Запускаем воспроизведение
             guild_state.voice_client.play(audio_source, after=after_callback)
@@ -1033,10 +3219,9 @@ async def play_next(ctx):
                 except asyncio.CancelledError:
                     pass
                 
-            skip_timer = asyncio.create_task(skip_after_timeout())
+            playback.skip_timer = asyncio.create_task(skip_after_timeout())
             
-            view = MusicControlView(ctx)
-            await ctx.send(f"▶️ Сейчас играет: {title}", view=view)
+            await show_now_playing(ctx, guild_state, f"▶️ Сейчас играет: {title}")
             
         except Exception as e:
             logger.error(f"Ошибка при воспроизведении аудио: {e}")
@@ -1052,35 +3237,70 @@ async def play_next(ctx):
         await ctx.send("❌ Произошла неизвестная ошибка при воспроизведении")
         await handle_song_complete(ctx, e)
 
+def get_free_space_gb() -> float:
+    """Возвращает свободное место во временной директории в ГБ"""
+    total, used, free = shutil.disk_usage(tempfile.gettempdir())
+    return free / (2**30)  # Конвертируем в ГБ
+
+def cleanup_temp_files(max_entries: int = TEMP_CLEANUP_MAX_ENTRIES, max_deletes: int = TEMP_CLEANUP_MAX_DELETES) -> int:
+    """Удаляет временные файлы yt-dlp и discord с ограничением объема работы за проход.
+
+    Итератор каталога живет между проходами, поэтому проход продолжает с места,
+    где остановился предыдущий, и читает не больше max_entries записей.
+    """
+    global temp_cleanup_entries
+    with temp_cleanup_lock:
+        if temp_cleanup_entries is None:
+            temp_cleanup_entries = os.scandir(tempfile.gettempdir())
+        entries = temp_cleanup_entries
+        scanned = deleted = 0
+        try:
+            for entry in entries:
+                scanned += 1
+                if entry.name.startswith('yt-dlp') or entry.name.startswith('discord-'):
+                    try:
+                        if entry.is_file(follow_symlinks=False):
+                            os.unlink(entry.path)
+                            deleted += 1
+                    except Exception as e:
+                        logger.error(f"Ошибка при удалении {entry.path}: {e}")
+                if scanned >= max_entries or deleted >= max_deletes:
+                    return deleted
+        except OSError as e:
+            logger.error(f"Ошибка чтения временной директории: {e}")
+        # Каталог пройден до конца: следующий проход откроет его заново
+        entries.close()
+        temp_cleanup_entries = None
+    return deleted
+
+def reclaim_disk_space() -> float:
+    """Освобождает место: сначала временные файлы, затем кэш Opus; возвращает свободные ГБ"""
+    deleted = cleanup_temp_files()
+    if deleted:
+        logger.info(f"Удалено временных файлов: {deleted}")
+    free_gb = get_free_space_gb()
+    if free_gb < DISK_LOW_GB and opus_cache.enabled:
+        # При нехватке кэш ужимается вдвое, при критической нехватке - полностью
+        target = 0 if free_gb < DISK_CRITICAL_GB else opus_cache.total_bytes // 2
+        freed = opus_cache.evict(target)
+        if freed:
+            logger.info(f"Кэш Opus сокращен на {freed / 2**20:.0f} МБ")
+            free_gb = get_free_space_gb()
+    return free_gb
+
 def check_disk_space():
     """Проверяет свободное место на диске и очищает временные файлы если нужно"""
     try:
-        # Получаем путь к временной директории
-        temp_dir = tempfile.gettempdir()
-        
-        # Проверяем свободное место
-        total, used, free = shutil.disk_usage(temp_dir)
-        free_gb = free / (2**30)  # Конвертируем в ГБ
+        free_gb = get_free_space_gb()
         
-        if free_gb < 0.5:  # Если меньше 500 МБ свободно
+        if free_gb < DISK_LOW_GB:  # Если меньше 500 МБ свободно
             logger.warning(f"Очень мало места на диске: {free_gb:.2f} ГБ")
             
-            # Очищаем временные файлы
-            for filename in os.listdir(temp_dir):
-                if filename.startswith('yt-dlp') or filename.startswith('discord-'):
-                    filepath = os.path.join(temp_dir, filename)
-                    try:
-                        if os.path.isfile(filepath):
-                            os.unlink(filepath)
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении {filepath}: {e}")
-            
-            # Проверяем место снова
-            total, used, free = shutil.disk_usage(temp_dir)
-            free_gb = free / (2**30)
+            # Очищаем временные файлы и кэш Opus
+            free_gb = reclaim_disk_space()
             logger.info(f"После очистки: {free_gb:.2f} ГБ свободно")
             
-            if free_gb < 0.1:  # Если меньше 100 МБ после очистки
+            if free_gb < DISK_CRITICAL_GB:  # Если меньше 100 МБ после очистки
                 logger.error("Критически мало места на диске")
                 return False
         
@@ -1090,6 +3310,179 @@ def check_disk_space():
         logger.error(f"Ошибка при проверке места на диске: {e}")
         return False
 
+class DiskSpaceMonitor:
+    """Фоновая проверка места на диске вместо проверки после каждого трека"""
+    OK, LOW, CRITICAL = 'ok', 'low', 'critical'
+
+    def __init__(self):
+        self.free_gb: Optional[float] = None  # Последнее измеренное значение
+        self.state = self.OK
+        self.checked_at = 0.0
+        self._task = None
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _sample(self) -> float:
+        """Замер и, при нехватке места, одна ограниченная очистка (в отдельном потоке)"""
+        free_gb = get_free_space_gb()
+        if free_gb < DISK_LOW_GB:
+            free_gb = reclaim_disk_space()
+        return free_gb
+
+    def _classify(self, free_gb: float) -> str:
+        if free_gb < DISK_CRITICAL_GB:
+            return self.CRITICAL
+        if free_gb < DISK_LOW_GB:
+            return self.LOW
+        return self.OK
+
+    async def _run(self):
+        while True:
+            try:
+                self.free_gb = await disk_pool.run(self._sample)
+                self.checked_at = time.time()
+                state = self._classify(self.free_gb)
+                if state != self.state:
+                    await self._on_state_change(self.state, state)
+                    self.state = state
+                await asyncio.sleep(DISK_CHECK_INTERVAL)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Ошибка при проверке места на диске: {e}")
+                await asyncio.sleep(DISK_CHECK_INTERVAL)
+
+    async def _on_state_change(self, old: str, new: str):
+        """Сообщает о пересечении порога один раз, а не после каждого трека"""
+        if new == self.OK:
+            logger.info(f"Место на диске восстановлено: {self.free_gb:.2f} ГБ")
+            return
+
+        message = f"⚠️ Внимание: мало места на диске ({self.free_gb:.2f} ГБ), возможны проблемы с воспроизведением"
+        if new == self.CRITICAL:
+            logger.error(f"Критически мало места на диске: {self.free_gb:.2f} ГБ")
+        else:
+            logger.warning(f"Очень мало места на диске: {self.free_gb:.2f} ГБ")
+
+        # Уведомляем владельца бота только при ухудшении состояния
+        if old == self.OK or new == self.CRITICAL:
+            try:
+                app_info = await bot.application_info()
+                await app_info.owner.send(message)
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить владельца бота: {e}")
+
+disk_monitor = DiskSpaceMonitor()
+
+class LoopLagMonitor:
+    """Гистограмма задержки цикла событий и стек колбэка, который его блокирует"""
+    def __init__(self):
+        self.counts = [0] * (len(LOOP_LAG_BUCKETS) + 1)
+        self.samples = 0
+        self.max_lag = 0.0
+        self.stalls = 0  # Сколько раз задержка превысила порог
+        self.last_stall_stack: Optional[str] = None
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self._task:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self._run())
+        # Стек можно снять только пока цикл заблокирован, поэтому нужен отдельный поток
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop_event.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._watchdog = None
+
+    def record(self, lag: float):
+        self.counts[bisect.bisect_left(LOOP_LAG_BUCKETS, lag)] += 1
+        self.samples += 1
+        self.max_lag = max(self.max_lag, lag)
+
+    def percentile(self, p: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль"""
+        if not self.samples:
+            return 0.0
+        threshold = self.samples * p
+        seen = 0
+        for bound, count in zip(LOOP_LAG_BUCKETS, self.counts):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return self.max_lag
+
+    def summary(self) -> str:
+        return (
+            f"p50 ≤{self.percentile(0.5) * 1000:.0f} мс, p99 ≤{self.percentile(0.99) * 1000:.0f} мс, "
+            f"max {self.max_lag * 1000:.0f} мс, зависаний {self.stalls}"
+        )
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                expected = loop.time() + LOOP_LAG_INTERVAL
+                await asyncio.sleep(LOOP_LAG_INTERVAL)
+                self._last_beat = time.monotonic()
+                self.record(max(0.0, loop.time() - expected))
+            except asyncio.CancelledError:
+                break
+
+    def _watch(self):
+        """Поток-сторож: если пульса нет дольше порога, пишет стек потока цикла"""
+        reported_beat = None
+        while not self._stop_event.wait(LOOP_LAG_INTERVAL):
+            beat = self._last_beat
+            lag = time.monotonic() - beat - LOOP_LAG_INTERVAL
+            if lag < LOOP_LAG_THRESHOLD or beat == reported_beat:
+                continue
+            reported_beat = beat  # Одно зависание - одна запись в лог
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self.stalls += 1
+            self.last_stall_stack = ''.join(traceback.format_stack(frame, limit=LOOP_LAG_STACK_LIMIT))
+            logger.warning(f"Цикл событий заблокирован на {lag * 1000:.0f} мс:\n{self.last_stall_stack}")
+
+loop_lag_monitor = LoopLagMonitor()
+
+def install_uvloop():
+    """Включает uvloop для bot.run, если он установлен"""
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("USE_UVLOOP=1, но uvloop не установлен, используется стандартный цикл")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Используется uvloop")
+
 async def handle_song_complete(ctx, error):
     """Обработчик завершения песни"""
     if isinstance(ctx, discord.Interaction):
@@ -1118,11 +3511,6 @@ async def handle_song_complete(ctx, error):
         except Exception as e:
             logger.error(f"Ошибка при очистке источника воспроизведения: {e}")
         
-        # Проверяем место на диске
-        if not check_disk_space():
-            logger.warning("Недостаточно места на диске, пропускаем следующий трек")
-            await ctx.send("⚠️ Внимание: мало места на диске, возможны проблемы с воспроизведением")
-        
         guild_state.current_track = None
         guild_state.is_playing = False
         
@@ -1146,16 +3534,125 @@ async def handle_song_complete(ctx, error):
             guild_state.disconnect_timer = DisconnectTimer()
         await guild_state.disconnect_timer.start(ctx)
 
+class PlaybackController:
+    """Конечный автомат воспроизведения одного сервера.
+
+    Поток аудиоплеера discord.py только кладет событие завершения трека в очередь
+    через call_soon_threadsafe; переходы (извлечение, подключение, сообщения)
+    выполняет задача контроллера в цикле событий по одному событию за раз.
+    """
+    IDLE, STARTING, PLAYING, RADIO = 'idle', 'starting', 'playing', 'radio'
+
+    def __init__(self, guild_state: 'GuildState'):
+        self.guild_state = guild_state
+        self.state = self.IDLE
+        self.ctx = None  # Контекст для сообщений о следующих треках
+        self.generation = 0  # Номер текущего трека, события старых треков отбрасываются
+        self.skip_timer: Optional[asyncio.Task] = None
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def request_play(self, ctx):
+        """Начать воспроизведение, если сейчас ничего не играет"""
+        self.ctx = ctx
+        self._post(('play', None, None))
+
+    def begin_track(self, ctx) -> int:
+        """Вызывается из play_next перед запуском трека, возвращает его номер"""
+        self.ctx = ctx
+        self._loop = asyncio.get_running_loop()
+        self._cancel_skip_timer()
+        self.generation += 1
+        return self.generation
+
+    def track_finished(self, generation: int, error: Optional[Exception]):
+        """Вызывается из потока плеера: не блокирует и не ждет обработки"""
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._post, ('finished', generation, error))
+
+    @property
+    def on_radio(self) -> bool:
+        return self.state == self.RADIO
+
+    def tune_radio(self) -> int:
+        """Отдает голосовой клиент радио: завершение прерванного трека очередь не запускает"""
+        self._loop = asyncio.get_running_loop()
+        self._cancel_skip_timer()
+        self.generation += 1
+        self.state = self.RADIO
+        return self.generation
+
+    def radio_finished(self, generation: int, error: Optional[Exception]):
+        """Вызывается из потока плеера, когда радио остановлено или станция закончилась"""
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._post, ('radio_ended', generation, error))
+
+    def _post(self, event: tuple):
+        self._events.put_nowait(event)
+        # Задача живет только пока есть события, простаивающие серверы ее не держат
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _cancel_skip_timer(self):
+        if self.skip_timer and not self.skip_timer.done():
+            self.skip_timer.cancel()
+        self.skip_timer = None
+
+    def _is_audio_active(self) -> bool:
+        voice_client = self.guild_state.voice_client
+        return bool(voice_client and (voice_client.is_playing() or voice_client.is_paused()))
+
+    async def _run(self):
+        while not self._events.empty():
+            kind, generation, error = self._events.get_nowait()
+            try:
+                if kind == 'radio_ended':
+                    if generation != self.generation:
+                        continue  # Сервер уже переключился на другую станцию
+                    if error:
+                        logger.error(f"Ошибка воспроизведения радио: {error}")
+                    self.state = self.IDLE
+                    self.guild_state.is_playing = False
+                    self.guild_state.current_track = None
+                elif kind == 'play':
+                    if self.state == self.RADIO:
+                        continue  # Пока играет радио, очередь не запускается
+                    # Событие завершения могло еще не дойти: проверяем сам голосовой клиент
+                    if self.state == self.PLAYING and not self._is_audio_active():
+                        self.state = self.IDLE
+                    if self.state != self.IDLE:
+                        continue
+                    self.state = self.STARTING
+                    await play_next(self.ctx)
+                elif kind == 'finished':
+                    if generation != self.generation:
+                        continue  # Трек уже сменился, событие устарело
+                    if error:
+                        logger.error(f"Ошибка воспроизведения: {error}")
+                    self._cancel_skip_timer()
+                    self.state = self.STARTING
+                    await handle_song_complete(self.ctx, error)
+            except Exception as e:
+                logger.error(f"Ошибка перехода между треками: {e}")
+            finally:
+                if self.state == self.STARTING:
+                    self.state = self.PLAYING if self.guild_state.is_playing else self.IDLE
+
 class MusicControlView(View):
-    def __init__(self, ctx):
+    """Постоянная панель управления, одна на весь процесс.
+
+    Регистрируется один раз в setup_hook. Кнопки имеют постоянные custom_id,
+    а сервер берется из interaction.guild_id, поэтому состояние самого View
+    не привязано ни к серверу, ни к треку.
+    """
+    def __init__(self):
         super().__init__(timeout=None)
-        self.ctx = ctx
-        self.guild_id = ctx.guild.id if isinstance(ctx, InteractionContext) else ctx.guild_id
         
-        # Создаем кнопки без custom_id
         self.play_pause = Button(
             style=ButtonStyle.primary,
             emoji="⏯️",
+            custom_id="music:play_pause",
             row=0
         )
         self.play_pause.callback = self.play_pause_callback
@@ -1163,6 +3660,7 @@ class MusicControlView(View):
         self.skip = Button(
             style=ButtonStyle.secondary,
             emoji="⏭️",
+            custom_id="music:skip",
             row=0
         )
         self.skip.callback = self.skip_callback
@@ -1170,6 +3668,7 @@ class MusicControlView(View):
         self.stop = Button(
             style=ButtonStyle.danger,
             emoji="⏹️",
+            custom_id="music:stop",
             row=0
         )
         self.stop.callback = self.stop_callback
@@ -1177,6 +3676,7 @@ class MusicControlView(View):
         self.queue = Button(
             style=ButtonStyle.secondary,
             emoji="📋",
+            custom_id="music:queue",
             row=0
         )
         self.queue.callback = self.queue_callback
@@ -1198,6 +3698,8 @@ class MusicControlView(View):
                 except:
                     pass
                 return False
+            if not interaction.guild_id:
+                return False
             return True
         except:
             return False
@@ -1220,7 +3722,7 @@ class MusicControlView(View):
             return
             
         try:
-            guild_state = get_guild_state(self.guild_id)
+            guild_state = get_guild_state(interaction.guild_id)
             
             if not guild_state.voice_client or not guild_state.voice_client.is_connected():
                 await self.handle_interaction_error(interaction, "❌ Бот не подключен к голосовому каналу!")
@@ -1228,9 +3730,11 @@ class MusicControlView(View):
                 
             if guild_state.voice_client.is_playing():
                 guild_state.voice_client.pause()
+                now_playing_updater.poke(interaction.guild_id)
                 await self.handle_interaction_error(interaction, "⏸️ Воспроизведение приостановлено")
             elif guild_state.voice_client.is_paused():
                 guild_state.voice_client.resume()
+                now_playing_updater.poke(interaction.guild_id)
                 await self.handle_interaction_error(interaction, "▶️ Воспроизведение возобновлено")
             else:
                 await self.handle_interaction_error(interaction, "❌ Сейчас ничего не играет!")
@@ -1243,7 +3747,7 @@ class MusicControlView(View):
             return
             
         try:
-            guild_state = get_guild_state(self.guild_id)
+            guild_state = get_guild_state(interaction.guild_id)
             
             if not guild_state.voice_client or not guild_state.voice_client.is_connected() or not guild_state.voice_client.is_playing():
                 await self.handle_interaction_error(interaction, "❌ Сейчас ничего не играет!")
@@ -1260,7 +3764,7 @@ class MusicControlView(View):
             return
             
         try:
-            guild_state = get_guild_state(self.guild_id)
+            guild_state = get_guild_state(interaction.guild_id)
             
             if not guild_state.voice_client or not guild_state.voice_client.is_connected():
                 await self.handle_interaction_error(interaction, "❌ Бот не подключен к голосовому каналу!")
@@ -1280,45 +3784,88 @@ class MusicControlView(View):
             return
             
         try:
-            guild_state = get_guild_state(self.guild_id)
+            guild_state = get_guild_state(interaction.guild_id)
             
-            async with guild_state._lock:
-                if not guild_state.queue and not guild_state.current_track:
-                    await self.handle_interaction_error(interaction, "❌ Очередь пуста!")
-                    return
-                
-                queue_text = []
-                if guild_state.current_track:
-                    queue_text.append("🎵 Сейчас играет:\n" + guild_state.current_track[1])
-                
-                if guild_state.queue:
-                    queue_text.append(f"\n📋 В очереди ({len(guild_state.queue)}/{MAX_QUEUE_SIZE}):")
-                    for idx, (_, title) in enumerate(guild_state.queue, 1):
-                        queue_text.append(f"{idx}. {title}")
-                
-                full_text = "\n".join(queue_text)
-                
-                if len(full_text) > 1900:
-                    parts = [full_text[i:i+1900] for i in range(0, len(full_text), 1900)]
-                    for i, part in enumerate(parts):
-                        if i == 0:
-                            await self.handle_interaction_error(interaction, f"Очередь (часть {i+1}/{len(parts)}):\n{part}")
-                        else:
-                            try:
-                                await interaction.followup.send(f"Очередь (часть {i+1}/{len(parts)}):\n{part}", ephemeral=True)
-                            except:
-                                pass
-                else:
-                    await self.handle_interaction_error(interaction, full_text)
+            if not guild_state.get_queue_length() and not guild_state.current_track:
+                await self.handle_interaction_error(interaction, "❌ Очередь пуста!")
+                return
+
+            view = QueueView(interaction.guild_id)
+            await interaction.response.send_message(embed=view.build_embed(), view=view, ephemeral=True)
         except Exception as e:
             logger.error(f"Ошибка в queue_callback: {e}")
             await self.handle_interaction_error(interaction, "❌ Произошла ошибка")
 
+class QueueView(View):
+    """Постраничный просмотр очереди с кнопками навигации"""
+    def __init__(self, guild_id: int, page: int = 0):
+        super().__init__(timeout=180)
+        self.guild_id = guild_id
+        self.page = page
+        self.total_pages = 1
+
+        self.prev_page = Button(
+            style=ButtonStyle.secondary,
+            emoji="◀️",
+            row=0
+        )
+        self.prev_page.callback = self.prev_page_callback
+
+        self.refresh = Button(
+            style=ButtonStyle.secondary,
+            emoji="🔄",
+            row=0
+        )
+        self.refresh.callback = self.refresh_callback
+
+        self.next_page = Button(
+            style=ButtonStyle.secondary,
+            emoji="▶️",
+            row=0
+        )
+        self.next_page.callback = self.next_page_callback
+
+        self.add_item(self.prev_page)
+        self.add_item(self.refresh)
+        self.add_item(self.next_page)
+
+    def build_embed(self) -> discord.Embed:
+        """Строит embed текущей страницы без обращения к сети"""
+        guild_state = get_guild_state(self.guild_id)
+        text, self.total_pages = guild_state.render_queue_page(self.page)
+        self.page = max(0, min(self.page, self.total_pages - 1))
+
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.total_pages - 1
+
+        embed = discord.Embed(title="Очередь", description=text or "❌ Очередь пуста!")
+        embed.set_footer(text=f"Страница {self.page + 1}/{self.total_pages}")
+        return embed
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        """Перерисовывает сообщение с указанной страницей"""
+        try:
+            self.page = page
+            embed = self.build_embed()
+            await interaction.response.edit_message(embed=embed, view=self)
+        except Exception as e:
+            logger.error(f"Ошибка при переключении страницы очереди: {e}")
+
+    async def prev_page_callback(self, interaction: discord.Interaction):
+        await self.show_page(interaction, self.page - 1)
+
+    async def refresh_callback(self, interaction: discord.Interaction):
+        await self.show_page(interaction, self.page)
+
+    async def next_page_callback(self, interaction: discord.Interaction):
+        await self.show_page(interaction, self.page + 1)
+
 @bot.tree.command(name="play", description="Добавляет трек или плейлист в очередь и начинает воспроизведение")
 @app_commands.describe(
-    query="Ссылка на видео/плейлист или поисковый запрос"
+    query="Ссылка на видео/плейлист или поисковый запрос",
+    first="Поставить трек первым в очереди"
 )
-async def play_slash(interaction: discord.Interaction, query: str):
+async def play_slash(interaction: discord.Interaction, query: str, first: bool = False):
     try:
         member = interaction.guild.get_member(interaction.user.id)
         if not member or not member.voice:
@@ -1331,21 +3878,49 @@ async def play_slash(interaction: discord.Interaction, query: str):
         guild_state = get_guild_state(interaction.guild_id)
         guild_state.update_activity()
         
-        if guild_state.get_queue_length() >= MAX_QUEUE_SIZE:
+        if guild_state.playback.on_radio:
+            await interaction.response.send_message(
+                "📻 Сейчас играет радио. Остановите его командой /skip, затем добавляйте треки",
+                ephemeral=True
+            )
+            return
+        
+        if not guild_state.queue.free_slots() and not guild_state.playlist_queue.free_slots():
             await interaction.response.send_message(
                 f"❌ Очередь переполнена! Максимальный размер: {MAX_QUEUE_SIZE} треков",
                 ephemeral=True
             )
             return
         
+        is_playlist = 'list=' in query or 'playlist' in query.lower()
+        # Повтор по ссылке отсекается до извлечения, поисковые запросы - после него
+        if not is_playlist and not guild_state.admits(parse_video_id(query)):
+            await interaction.response.send_message("⚠️ Этот трек уже в очереди", ephemeral=True)
+            return
+        
         await interaction.response.send_message("🔍 Ищу трек...")
         
         try:
-            is_playlist = 'list=' in query or 'playlist' in query.lower()
+            if local_library.enabled and query.startswith(LOCAL_PREFIX):
+                # Локальный файл: без сети и без извлечения
+                track = local_library.resolve(query)
+                if not track:
+                    await interaction.edit_original_response(content="❌ В локальной библиотеке ничего не найдено")
+                    return
+                if await guild_state.add_to_queue(track, play_next=first):
+                    await interaction.edit_original_response(content=f"📁 Трек '{track.title}' добавлен в очередь!")
+                    guild_state.playback.request_play(InteractionContext(interaction))
+                else:
+                    await interaction.edit_original_response(content="❌ Не удалось добавить трек: очередь переполнена")
+                return
+
             if is_playlist:
                 await interaction.edit_original_response(content="🔍 Загружаю плейлист...")
             
-            audio_info = await youtube_client.extract_info(query, process_playlist=is_playlist)
+            target_bitrate = member.voice.channel.bitrate // 1000
+            audio_info = await youtube_client.extract_info(
+                query, process_playlist=is_playlist, target_bitrate=target_bitrate, guild_id=interaction.guild_id
+            )
             
             if isinstance(audio_info, list):
                 tracks_added = await guild_state.add_to_queue(audio_info)
@@ -1354,11 +3929,13 @@ async def play_slash(interaction: discord.Interaction, query: str):
                         content="❌ Не удалось добавить треки: очередь переполнена"
                     )
                 else:
+                    skipped = len(audio_info) - tracks_added
                     await interaction.edit_original_response(
                         content=f"📋 Добавлено {tracks_added} треков из плейлиста в очередь!"
+                        + (f" Пропущено повторов и не поместившихся: {skipped}" if skipped else "")
                     )
             else:
-                tracks_added = await guild_state.add_to_queue(audio_info)
+                tracks_added = await guild_state.add_to_queue(audio_info, play_next=first)
                 if tracks_added == 0:
                     await interaction.edit_original_response(
                         content="❌ Не удалось добавить трек: очередь переполнена"
@@ -1368,9 +3945,13 @@ async def play_slash(interaction: discord.Interaction, query: str):
                         content=f"🎵 Трек '{audio_info[1]}' добавлен в очередь!"
                     )
             
-            if not guild_state.is_playing and tracks_added > 0:
-                await play_next(interaction)
+            if tracks_added > 0:
+                guild_state.playback.request_play(InteractionContext(interaction))
                 
+        except DuplicateTrackError as e:
+            await interaction.edit_original_response(
+                content=f"⚠️ Трек '{e}' уже в очереди"
+            )
         except YouTubeAccessError as e:
             await interaction.edit_original_response(
                 content=f"🚫 YouTube Error: {str(e)}"
@@ -1393,6 +3974,22 @@ async def play_slash(interaction: discord.Interaction, query: str):
                 content="❌ Произошла ошибка при обработке команды"
             )
 
+@play_slash.autocomplete('query')
+async def play_query_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    """Подсказки по ранее игравшим трекам и локальной библиотеке без запросов к YouTube"""
+    if len(current) < 2 or current.startswith(('http://', 'https://')):
+        return []
+    if current.startswith(LOCAL_PREFIX):
+        hits = local_library.search(current[len(LOCAL_PREFIX):])
+    else:
+        hits = title_index.search(interaction.guild_id, current)
+        if local_library.enabled and len(hits) < 25:
+            hits += [(f"📁 {title}", value) for title, value in local_library.search(current, 25 - len(hits))]
+    return [
+        app_commands.Choice(name=title[:100], value=value[:100])
+        for title, value in hits
+    ]
+
 @bot.tree.command(name="skip", description="Пропускает текущий трек")
 async def skip_slash(interaction: discord.Interaction):
     guild_state = get_guild_state(interaction.guild_id)
@@ -1452,40 +4049,16 @@ async def queue_slash(interaction: discord.Interaction):
     guild_state = get_guild_state(interaction.guild_id)
     guild_state.update_activity()
     
-    async with guild_state._lock:  # Блокируем для получения консистентного состояния
-        if not guild_state.queue and not guild_state.current_track:
-            await interaction.response.send_message(
-                "❌ Очередь пуста!",
-                ephemeral=True
-            )
-            return
-        
-        queue_text = []
-        if guild_state.current_track:
-            queue_text.append("🎵 Сейчас играет:\n" + guild_state.current_track[1])
-        
-        if guild_state.queue:
-            queue_text.append(f"\n📋 В очереди ({len(guild_state.queue)}/{MAX_QUEUE_SIZE}):")
-            for idx, (_, title) in enumerate(guild_state.queue, 1):
-                queue_text.append(f"{idx}. {title}")
-        
-        full_text = "\n".join(queue_text)
-        
-        if len(full_text) > 1900:
-            parts = [full_text[i:i+1900] for i in range(0, len(full_text), 1900)]
-            for i, part in enumerate(parts):
-                if i == 0:
-                    await interaction.response.send_message(
-                        f"Очередь (часть {i+1}/{len(parts)}):\n{part}",
-                        ephemeral=True
-                    )
-                else:
-                    await interaction.followup.send(
-                        f"Очередь (часть {i+1}/{len(parts)}):\n{part}",
-                        ephemeral=True
-                    )
-        else:
-            await interaction.response.send_message(full_text, ephemeral=True)
+    if not guild_state.get_queue_length() and not guild_state.current_track:
+        await interaction.response.send_message(
+            "❌ Очередь пуста!",
+            ephemeral=True
+        )
+        return
+
+    # Рендерим только первую страницу, остальные - по кнопкам
+    view = QueueView(interaction.guild_id)
+    await interaction.response.send_message(embed=view.build_embed(), view=view, ephemeral=True)
 
 @bot.tree.command(name="remove", description="Удаляет трек из очереди по индексу")
 @app_commands.describe(index="Номер трека в очереди")
@@ -1517,6 +4090,180 @@ async def remove_slash(interaction: discord.Interaction, index: int):
             ephemeral=True
         )
 
+@bot.tree.command(name="move", description="Перемещает трек в очереди на другую позицию")
+@app_commands.describe(index="Номер трека в очереди", position="Новая позиция трека")
+async def move_slash(interaction: discord.Interaction, index: int, position: int):
+    guild_state = get_guild_state(interaction.guild_id)
+    queue_length = len(guild_state.queue)
+
+    if not 1 <= index <= queue_length or not 1 <= position <= queue_length:
+        await interaction.response.send_message(
+            "❌ Некорректный индекс трека!",
+            ephemeral=True
+        )
+        return
+
+    try:
+        moved = await guild_state.move_track(index - 1, position - 1)
+        await interaction.response.send_message(
+            f"↕️ Трек '{moved[1]}' перемещён на позицию {position}."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка перемещения трека: {str(e)}")
+        await interaction.response.send_message(
+            "❌ Ошибка при перемещении трека",
+            ephemeral=True
+        )
+
+@bot.tree.command(name="shuffle", description="Перемешивает очередь воспроизведения")
+async def shuffle_slash(interaction: discord.Interaction):
+    guild_state = get_guild_state(interaction.guild_id)
+
+    if not guild_state.queue:
+        await interaction.response.send_message(
+            "❌ Очередь пуста!",
+            ephemeral=True
+        )
+        return
+
+    await guild_state.shuffle_queue()
+    await interaction.response.send_message("🔀 Очередь перемешана!")
+
+@bot.tree.command(name="dedup", description="Настраивает защиту от повторов в очереди (для администраторов)")
+@app_commands.describe(
+    copies="Максимум копий одного трека в очереди (0 - без ограничений, 1 - запрет повторов)",
+    collapse="Убирать повторы при импорте плейлиста"
+)
+@app_commands.default_permissions(administrator=True)
+async def dedup_slash(interaction: discord.Interaction, copies: app_commands.Range[int, 0, 100], collapse: bool = False):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ Эта команда только для администраторов!", ephemeral=True)
+        return
+
+    guild_state = get_guild_state(interaction.guild_id)
+    guild_state.dedup_policy = DedupPolicy(copies, collapse)
+    dedup_policies.set(interaction.guild_id, guild_state.dedup_policy)
+    limit = "без ограничений" if not copies else f"не больше {copies}"
+    await interaction.response.send_message(
+        f"🔁 Копий одного трека в очереди: {limit}; повторы из плейлистов {'убираются' if collapse else 'сохраняются'}",
+        ephemeral=True
+    )
+
+radio_group = app_commands.Group(name="radio", description="Радио: один поток для многих серверов")
+
+@radio_group.command(name="start", description="Запускает радиостанцию")
+@app_commands.describe(name="Название станции", query="Ссылка на видео или поисковый запрос")
+async def radio_start_slash(interaction: discord.Interaction, name: str, query: str):
+    # default_permissions не действует на подкоманды группы, поэтому проверяем сами
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ Эта команда только для администраторов!", ephemeral=True)
+        return
+
+    station = broadcast_stations.get(name)
+    if station and not station.finished:
+        await interaction.response.send_message("❌ Станция с таким названием уже работает!", ephemeral=True)
+        return
+
+    await interaction.response.send_message("🔍 Ищу трек...")
+    try:
+        track = await youtube_client.extract_info(query, target_bitrate=BROADCAST_BITRATE)
+        if isinstance(track, list):
+            await interaction.edit_original_response(content="❌ Для радио нужна ссылка на одно видео")
+            return
+        station = BroadcastStation(name, track, interaction.guild_id)
+        await spawn_pool.run(station.start)
+        broadcast_stations[name] = station
+        await interaction.edit_original_response(content=f"📻 Станция **{name}** в эфире: {track.title}")
+    except YouTubeAccessError as e:
+        await interaction.edit_original_response(content=f"🚫 YouTube Error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Ошибка запуска радио: {e}")
+        await interaction.edit_original_response(content="❌ Не удалось запустить станцию")
+
+@radio_group.command(name="join", description="Подключает сервер к радиостанции")
+@app_commands.describe(name="Название станции")
+async def radio_join_slash(interaction: discord.Interaction, name: str):
+    station = broadcast_stations.get(name)
+    if not station or station.finished:
+        await interaction.response.send_message("❌ Такой станции нет в эфире!", ephemeral=True)
+        return
+
+    member = interaction.guild.get_member(interaction.user.id)
+    if not member or not member.voice:
+        await interaction.response.send_message("❌ Вы должны быть в голосовом канале!", ephemeral=True)
+        return
+
+    guild_state = get_guild_state(interaction.guild_id)
+    if guild_state.playback.state == PlaybackController.STARTING:
+        await interaction.response.send_message("⏳ Трек из очереди как раз запускается, попробуйте через пару секунд", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+    try:
+        ctx = InteractionContext(interaction)
+        voice_client = await connect_to_voice(ctx)
+        guild_state.update_voice_client(voice_client)
+        # Переход через контроллер: завершение прерванного трека не запустит очередь поверх радио
+        playback = guild_state.playback
+        generation = playback.tune_radio()
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+
+        def after_radio(error):
+            playback.radio_finished(generation, error)
+
+        voice_client.play(station.subscribe(interaction.guild_id), after=after_radio)
+        guild_state.is_playing = True
+        guild_state.current_track = station.track
+        await interaction.followup.send(f"📻 Слушаем станцию **{name}**: {station.track.title}")
+    except Exception as e:
+        logger.error(f"Ошибка подключения к радио: {e}")
+        if guild_state.playback.on_radio and not guild_state.playback._is_audio_active():
+            guild_state.playback.state = PlaybackController.IDLE
+        await interaction.followup.send("❌ Не удалось подключиться к станции", ephemeral=True)
+
+@radio_group.command(name="stop", description="Останавливает радиостанцию")
+@app_commands.describe(name="Название станции")
+async def radio_stop_slash(interaction: discord.Interaction, name: str):
+    station = broadcast_stations.get(name)
+    if not station:
+        await interaction.response.send_message("❌ Такой станции нет!", ephemeral=True)
+        return
+
+    # Станцию слушают и другие серверы: остановить ее могут только администраторы
+    # сервера, который ее запустил, или владелец бота
+    is_station_admin = (
+        interaction.guild_id == station.guild_id
+        and interaction.user.guild_permissions.administrator
+    )
+    if not is_station_admin and not await bot.is_owner(interaction.user):
+        await interaction.response.send_message(
+            "❌ Остановить станцию могут только администраторы сервера, который ее запустил!",
+            ephemeral=True
+        )
+        return
+
+    if broadcast_stations.get(name) is station:
+        del broadcast_stations[name]
+    station.stop()
+    await interaction.response.send_message(f"📻 Станция **{name}** остановлена")
+
+@radio_group.command(name="list", description="Показывает активные радиостанции")
+async def radio_list_slash(interaction: discord.Interaction):
+    for name, station in list(broadcast_stations.items()):
+        if station.finished:
+            del broadcast_stations[name]
+    if not broadcast_stations:
+        await interaction.response.send_message("📻 Сейчас нет станций в эфире", ephemeral=True)
+        return
+    lines = [
+        f"📻 **{name}**: {station.track.title} (слушателей: {len(station.listeners)})"
+        for name, station in broadcast_stations.items()
+    ]
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+bot.tree.add_command(radio_group)
+
 @bot.tree.command(name="clear", description="Очищает очередь воспроизведения")
 async def clear_slash(interaction: discord.Interaction):
     guild_state = get_guild_state(interaction.guild_id)
@@ -1536,9 +4283,11 @@ async def pause_slash(interaction: discord.Interaction):
         
     if guild_state.voice_client.is_playing():
         guild_state.voice_client.pause()
+        now_playing_updater.poke(interaction.guild_id)
         await interaction.response.send_message("⏸️ Воспроизведение приостановлено")
     elif guild_state.voice_client.is_paused():
         guild_state.voice_client.resume()
+        now_playing_updater.poke(interaction.guild_id)
         await interaction.response.send_message("▶️ Воспроизведение возобновлено")
     else:
         await interaction.response.send_message(
@@ -1566,20 +4315,25 @@ async def on_voice_state_update(member, before, after):
 
 @bot.tree.command(name="help", description="Показывает список доступных команд")
 async def help_slash(interaction: discord.Interaction):
-    help_text = """🎵 **Музыкальные команды:**
-`/play` - Добавить трек или плейлист в очередь
+    help_text = f"""🎵 **Музыкальные команды:**
+`/play` - Добавить трек или плейлист в очередь (`local:название` - из локальной библиотеки)
 `/pause` - Приостановить/возобновить воспроизведение
 `/skip` - Пропустить текущий трек
 `/queue` - Показать очередь воспроизведения
 `/remove` - Удалить трек из очереди по номеру
+`/move` - Переместить трек в очереди
+`/shuffle` - Перемешать очередь
+`/dedup` - Настроить защиту от повторов (для администраторов)
+`/reload` - Перечитать настройки (для администраторов)
 `/clear` - Очистить очередь
 `/leave` - Отключить бота от канала
+`/radio join` - Подключиться к радиостанции
 
 🎮 **Управление:**
 • Используйте кнопки под сообщением о текущем треке для быстрого управления
 • Бот автоматически отключается после 10 минут бездействия
 • Максимальная длина трека - 2 часа
-• Максимальный размер очереди - 50 треков"""
+• Максимальный размер очереди - {MAX_QUEUE_SIZE} треков"""
     await interaction.response.send_message(help_text)
 
 @bot.tree.command(name="igor", description="Секретная команда для Игоря")
@@ -1598,6 +4352,7 @@ async def fix_slash(interaction: discord.Interaction):
         
         # Принудительная синхронизация команд
         commands = await bot.tree.sync()
+        write_command_hash(command_tree_hash(bot.tree))
         
         # Очищаем состояния серверов
         for guild_id, state in list(guild_states.items()):
@@ -1623,12 +4378,256 @@ async def fix_slash(interaction: discord.Interaction):
             content="❌ Произошла ошибка при перезагрузке бота"
         )
 
+def ffmpeg_process_stats() -> Dict[int, dict]:
+    """CPU и RSS дочерних процессов ffmpeg по данным /proc (только Linux)"""
+    if not os.path.isdir('/proc'):
+        return {}
+
+    parent = os.getpid()
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    with open('/proc/uptime', 'r') as f:
+        uptime = float(f.read().split()[0])
+
+    result = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Имя процесса в скобках может содержать пробелы
+        comm = stat[stat.find('(') + 1:stat.rfind(')')]
+        fields = stat[stat.rfind(')') + 2:].split()
+        if comm != 'ffmpeg' or int(fields[1]) != parent:
+            continue
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        lifetime = max(uptime - int(fields[19]) / ticks, 0.001)
+        result[int(name)] = {
+            'cpu_percent': cpu_seconds / lifetime * 100,
+            'rss_mb': int(fields[21]) * page_size / (2**20)
+        }
+    return result
+
+def count_registered_views() -> int:
+    """Количество View, зарегистрированных в хранилище discord.py"""
+    try:
+        view_store = bot._connection._view_store
+        views = {item.view for items in view_store._views.values() for item in items.values()}
+        views.update(view_store._synced_message_views.values())
+        return len(views)
+    except Exception:
+        return -1
+
+async def collect_runtime_stats() -> dict:
+    """Собирает состояние процесса за один проход без блокировок серверов"""
+    loop = asyncio.get_running_loop()
+
+    # Задержка цикла событий: сколько ждет уже готовый к запуску колбэк
+    started = loop.time()
+    await asyncio.sleep(0)
+    loop_lag = loop.time() - started
+
+    ffmpeg = await disk_pool.run(ffmpeg_process_stats)
+
+    # Снимок состояний читается синхронно, поэтому он согласован без блокировок
+    guilds = []
+    for guild_id, state in list(guild_states.items()):
+        snapshot = state.snapshot()
+        source = state.voice_client.source if state.voice_client else None
+        process = getattr(source, '_process', None)
+        pid = getattr(process, 'pid', None)
+        guilds.append({
+            'guild_id': guild_id,
+            'queue': snapshot.queue_length,
+            'playlist': snapshot.playlist_length,
+            'playing': snapshot.current_track.title if snapshot.current_track else None,
+            'ffmpeg': ffmpeg.get(pid) if pid else None
+        })
+
+    return {
+        'guilds': guilds,
+        'ffmpeg': ffmpeg,
+        'audio_cache': len(audio_cache.cache),
+        'track_cache': len(track_cache),
+        'pools': [pool.stats() for pool in (youtube_client.executor, spawn_pool, disk_pool, local_library.pool)],
+        'extract_tenants': youtube_client.executor.tenants(),
+        'library': len(local_library) if local_library.enabled else None,
+        'opus_cache': opus_cache.summary() if opus_cache.enabled else "отключен",
+        'tasks': len(asyncio.all_tasks()),
+        'loop_lag': loop_lag,
+        'loop_lag_summary': loop_lag_monitor.summary(),
+        'views': count_registered_views()
+    }
+
+def format_runtime_stats(stats: dict) -> str:
+    """Текст отчета /stats"""
+    ffmpeg = stats['ffmpeg']
+    total_cpu = sum(p['cpu_percent'] for p in ffmpeg.values())
+    total_rss = sum(p['rss_mb'] for p in ffmpeg.values())
+    lines = [
+        "📊 **Состояние бота**",
+        f"Серверов: {len(stats['guilds'])}, треков в очередях: {sum(g['queue'] + g['playlist'] for g in stats['guilds'])}",
+        f"ffmpeg: {len(ffmpeg)} процессов, CPU {total_cpu:.1f}%, RSS {total_rss:.1f} МБ",
+        f"Кэш: audio_cache {stats['audio_cache']}, track_cache {stats['track_cache']}",
+        f"Кэш Opus: {stats['opus_cache']}",
+        *([f"Локальная библиотека: {stats['library']} файлов"] if stats['library'] is not None else []),
+        "Пулы: " + ", ".join(
+            f"{p['name']} {p['running']}/{p['workers']} (в очереди {p['queued']}, "
+            f"ожидание p50 {p['wait_p50'] * 1000:.0f}/p95 {p['wait_p95'] * 1000:.0f} мс)" for p in stats['pools']
+        ),
+        f"Задач asyncio: {stats['tasks']}, задержка цикла: {stats['loop_lag'] * 1000:.1f} мс",
+        f"Задержка цикла за время работы: {stats['loop_lag_summary']}",
+        f"Зарегистрированных View: {stats['views']}",
+    ]
+
+    tenants = stats['extract_tenants']
+    if tenants:
+        lines.append("\n**Очередь извлечения** (место в обходе, ждут/выполняются, самое долгое ожидание):")
+    for t in tenants[:STATS_MAX_GUILDS]:
+        name = f"`{t['tenant']}`" if t['tenant'] is not None else "без сервера"
+        position = f"#{t['position'] + 1}" if t['position'] is not None else "-"
+        kind = {PRIORITY_INTERACTIVE: ", интерактивные", PRIORITY_BACKGROUND: ", фоновые"}.get(t['priority'], "")
+        lines.append(f"{name} {position}{kind}: {t['queued']}/{t['running']}, {t['oldest_wait']:.1f} с")
+
+    guilds = sorted(stats['guilds'], key=lambda g: g['queue'] + g['playlist'], reverse=True)
+    if guilds:
+        lines.append("\n**Серверы** (по размеру очереди):")
+    for g in guilds[:STATS_MAX_GUILDS]:
+        line = f"`{g['guild_id']}` очередь {g['queue']}, плейлист {g['playlist']}"
+        if g['ffmpeg']:
+            line += f", ffmpeg CPU {g['ffmpeg']['cpu_percent']:.1f}% RSS {g['ffmpeg']['rss_mb']:.1f} МБ"
+        if g['playing']:
+            line += f" - {g['playing'][:40]}"
+        lines.append(line)
+    if len(guilds) > STATS_MAX_GUILDS:
+        lines.append(f"... и еще {len(guilds) - STATS_MAX_GUILDS}")
+    return "\n".join(lines)[:2000]
+
+@bot.tree.command(name="stats", description="Показывает состояние бота (для владельца бота)")
+@app_commands.default_permissions(administrator=True)
+async def stats_slash(interaction: discord.Interaction):
+    # Отчет охватывает все серверы процесса, поэтому администратора одного сервера недостаточно
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Эта команда только для владельца бота!", ephemeral=True)
+        return
+
+    try:
+        stats = await collect_runtime_stats()
+        await interaction.response.send_message(format_runtime_stats(stats), ephemeral=True)
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды stats: {e}")
+        if not interaction.response.is_done():
+            await interaction.response.send_message("❌ Не удалось собрать статистику", ephemeral=True)
+
+@bot.tree.command(name="reload", description="Перечитывает настройки без перезапуска (для владельца бота)")
+@app_commands.default_permissions(administrator=True)
+async def reload_slash(interaction: discord.Interaction):
+    # Настройки общие для всех серверов процесса, поэтому администратора одного сервера недостаточно
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Эта команда только для владельца бота!", ephemeral=True)
+        return
+
+    changes, errors = await runtime_settings.reload()
+    lines = []
+    if changes:
+        lines.append("✅ Настройки обновлены:")
+        lines += [f"• `{name}`: {old} → {new}" for name, (old, new) in changes.items()]
+    if errors:
+        lines.append("❌ Не применены:")
+        lines += [f"• {e}" for e in errors]
+    await interaction.response.send_message("\n".join(lines or ["✅ Настройки не изменились"])[:2000], ephemeral=True)
+
+@bot.tree.command(name="rescan", description="Пересканирует локальную музыкальную библиотеку (для администраторов)")
+@app_commands.default_permissions(administrator=True)
+async def rescan_slash(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ Эта команда только для администраторов!", ephemeral=True)
+        return
+    if not local_library.enabled:
+        await interaction.response.send_message("❌ Локальная библиотека не настроена (MUSIC_LIBRARY_DIRS)", ephemeral=True)
+        return
+
+    local_library.request_rescan()
+    await interaction.response.send_message(
+        f"🔄 Сканирование запущено, сейчас в библиотеке {len(local_library)} файлов",
+        ephemeral=True
+    )
+
+class PlayerClientStats:
+    """Успешность и задержка извлечения для каждого player_client YouTube"""
+    def __init__(self, clients: List[str]):
+        self.clients = list(clients)
+        self._stats = {client: {'ok': 0, 'fail': 0, 'latency': deque(maxlen=100)} for client in clients}
+        self._lock = threading.Lock()  # Записи приходят из потоков пула
+
+    def record(self, client: str, ok: bool, latency: float):
+        with self._lock:
+            stats = self._stats[client]
+            stats['ok' if ok else 'fail'] += 1
+            if ok:
+                stats['latency'].append(latency)
+
+    def _percentile(self, client: str, percentile: float) -> Optional[float]:
+        samples = sorted(self._stats[client]['latency'])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+    def success_rate(self, client: str) -> float:
+        stats = self._stats[client]
+        total = stats['ok'] + stats['fail']
+        return stats['ok'] / total if total else 1.0
+
+    def ranked(self) -> List[str]:
+        """Клиенты от лучшего к худшему: медианная задержка с поправкой на ошибки"""
+        with self._lock:
+            def score(item):
+                position, client = item
+                median = self._percentile(client, 0.5)
+                if median is None:
+                    return (1, position)  # Без статистики сохраняем порядок по умолчанию
+                return (0, median / max(self.success_rate(client), 0.05))
+            return [client for _, client in sorted(enumerate(self.clients), key=score)]
+
+    def hedge_delay(self, client: str) -> float:
+        """Через сколько секунд ожидания основного клиента запускать запасной"""
+        with self._lock:
+            latency = self._percentile(client, HEDGE_PERCENTILE)
+        if latency is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, latency)
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                client: {
+                    'ok': stats['ok'],
+                    'fail': stats['fail'],
+                    'p50': self._percentile(client, 0.5),
+                    'p90': self._percentile(client, 0.9)
+                }
+                for client, stats in self._stats.items()
+            }
+
+def with_player_client(ydl_opts: dict, client: str) -> dict:
+    """Копия параметров yt-dlp с другим player_client"""
+    extractor_args = dict(ydl_opts.get('extractor_args', {}))
+    extractor_args['youtube'] = {**extractor_args.get('youtube', {}), 'player_client': [client]}
+    return {**ydl_opts, 'extractor_args': extractor_args}
+
 # Пул для асинхронных HTTP-запросов
 class YouTubeClient:
-    def __init__(self, max_connections=10):
+    def __init__(self, max_connections=EXTRACT_WORKERS):
         self.session = None
-        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+        # Фоновое разрешение плейлистов не может занять потоки, зарезервированные под /play
+        self.executor = WorkPool('extract', max_connections, max_connections - EXTRACT_INTERACTIVE_RESERVE)
+        # Один сервер с большим плейлистом не может занять все потоки извлечения
+        self.executor.set_limits(EXTRACT_GUILD_INFLIGHT, parse_guild_weights(EXTRACT_GUILD_WEIGHTS))
         self._lock = asyncio.Lock()
+        self.client_stats = PlayerClientStats(PLAYER_CLIENTS)
         
     async def get_session(self):
         if not self.session:
@@ -1641,9 +4640,11 @@ class YouTubeClient:
             self.session = None
         self.executor.shutdown(wait=False)
 
-    async def extract_info(self, url: str, process_playlist: bool = False) -> Union[Tuple[str, str], List[Tuple[str, str]]]:
-        """Асинхронное извлечение информации о видео"""
-        cache_key = f"{url}_{process_playlist}"
+    async def extract_info(self, url: str, process_playlist: bool = False, target_bitrate: Optional[int] = None,
+                           guild_id: Optional[int] = None) -> Union[Track, List[dict]]:
+        """Асинхронное извлечение информации о видео или плоского списка плейлиста;
+        guild_id - сервер, в чью долю пула извлечения засчитывается запрос"""
+        cache_key = f"{url}_{process_playlist}_{target_bitrate}"
         
         # Проверяем кэш
         cached_data = audio_cache.get(cache_key)
@@ -1658,30 +4659,35 @@ class YouTubeClient:
             if not url.startswith(('http://', 'https://')):
                 url = f"ytsearch:{url}"
 
-            ydl_opts = YDL_OPTIONS.copy()
+            result = None
+
             if process_playlist:
-                ydl_opts.update({
-                    'extract_flat': 'in_playlist',
-                    'playlistend': 50,
-                    'playlistreverse': False,
-                    'playlist_items': '1-50'
-                })
-
-            # Выполняем запрос в отдельном потоке
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(
-                self.executor,
-                lambda: youtube_dl.YoutubeDL(ydl_opts).extract_info(url, download=False)
-            )
+                # Плейлист перечисляем постранично, без извлечения потоков
+                ydl_opts = {**YDL_OPTIONS, **PLAYLIST_YDL_OPTIONS}
+                entries, video_info = await self.executor.run(
+                    enumerate_playlist_sync, url, ydl_opts,
+                    priority=PRIORITY_INTERACTIVE, tenant=guild_id
+                )
+                if entries is not None:
+                    result = self._process_playlist(entries)
+                elif video_info:
+                    # Ссылка оказалась одиночным видео: доразбираем уже полученный ответ
+                    ydl_opts = YDL_OPTIONS.copy()
+                    info = await self.executor.run(
+                        resolve_video_sync, video_info, ydl_opts,
+                        priority=PRIORITY_INTERACTIVE, tenant=guild_id
+                    )
+                    result = await self._process_video(info, ydl_opts, target_bitrate)
 
-            if not info:
-                raise YouTubeAccessError("Не удалось получить информацию о видео")
+            if result is None:
+                # Выполняем запрос в отдельном потоке с запасным клиентом
+                ydl_opts = YDL_OPTIONS.copy()
+                info = await self._extract_hedged(url, ydl_opts, guild_id)
 
-            # Обработка результатов
-            if process_playlist and ('entries' in info or info.get('_type') == 'playlist'):
-                result = await self._process_playlist(info, ydl_opts)
-            else:
-                result = await self._process_video(info, ydl_opts)
+                if not info:
+                    raise YouTubeAccessError("Не удалось получить информацию о видео")
+
+                result = await self._process_video(info, ydl_opts, target_bitrate)
 
             # Сохраняем в кэш
             audio_cache.set(cache_key, result)
@@ -1691,60 +4697,71 @@ class YouTubeClient:
             logger.error(f"Ошибка при извлечении информации: {str(e)}")
             raise YouTubeAccessError(str(e))
 
-    async def _process_playlist(self, info: dict, ydl_opts: dict) -> List[Tuple[str, str]]:
-        """Обработка плейлиста"""
-        entries = info.get('entries', [])
-        if not entries:
-            raise YouTubeAccessError("Плейлист пуст или недоступен")
-
-        tasks = []
-        for entry in entries:
-            if not entry or entry.get('availability') in ['private', 'needs_auth']:
-                continue
+    def _extract_with_client(self, url: str, ydl_opts: dict, client: str) -> Optional[dict]:
+        """Извлекает информацию одним player_client и учитывает результат (в потоке пула)"""
+        started = time.perf_counter()
+        info = None
+        try:
+            info = create_ydl(with_player_client(ydl_opts, client)).extract_info(url, download=False)
+            return info
+        finally:
+            self.client_stats.record(client, bool(info), time.perf_counter() - started)
 
-            video_url = entry.get('url') or entry.get('webpage_url')
-            if not video_url and entry.get('id'):
-                video_url = f"https://www.youtube.com/watch?v={entry['id']}"
+    async def _extract_hedged(self, url: str, ydl_opts: dict, guild_id: Optional[int] = None) -> Optional[dict]:
+        """Хеджированный запрос: если основной клиент не ответил за перцентиль своей
+        задержки, параллельно запускается запасной, берется первый успешный ответ.
 
-            if video_url:
-                tasks.append(self._process_video_entry(video_url, ydl_opts))
+        Отмена проигравшего снимает его из очереди пула, но уже запущенный поток
+        yt-dlp прервать нельзя - его результат просто отбрасывается.
+        """
+        primary, alternate = self.client_stats.ranked()[:2]
 
-        # Выполняем запросы параллельно с ограничением
-        results = []
-        chunk_size = 5  # Обрабатываем по 5 видео одновременно
-        for i in range(0, len(tasks), chunk_size):
-            chunk = tasks[i:i + chunk_size]
-            chunk_results = await asyncio.gather(*chunk, return_exceptions=True)
-            results.extend(r for r in chunk_results if isinstance(r, tuple))
+        def start(client):
+            return self.executor.run(
+                self._extract_with_client, url, ydl_opts, client,
+                priority=PRIORITY_INTERACTIVE, tenant=guild_id
+            )
 
-        if not results:
-            raise YouTubeAccessError("В плейлисте нет доступных треков")
-        return results
+        pending = {start(primary)}
+        done, _ = await asyncio.wait(pending, timeout=self.client_stats.hedge_delay(primary))
+        if done:
+            future = done.pop()
+            if not future.exception() and future.result():
+                return future.result()
+            logger.warning(f"Клиент {primary} не смог извлечь {url}, пробуем {alternate}")
+            pending = set()
+        else:
+            logger.info(f"Клиент {primary} отвечает дольше обычного, запускаем {alternate}")
+        pending.add(start(alternate))
 
-    async def _process_video_entry(self, url: str, ydl_opts: dict) -> Optional[Tuple[str, str]]:
-        """Обработка отдельного видео из плейлиста"""
+        last_error = None
         try:
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(
-                self.executor,
-                lambda: youtube_dl.YoutubeDL(ydl_opts).extract_info(url, download=False)
-            )
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception():
+                        last_error = future.exception()
+                    elif future.result():
+                        return future.result()
+        finally:
+            for future in pending:
+                future.cancel()
 
-            if not info or info.get('duration', 0) > 7200:
-                return None
-
-            audio_url = get_best_audio_format(info.get('formats', []))
-            if not audio_url:
-                return None
+        if last_error:
+            raise last_error
+        return None
 
-            title = info.get('title', 'Без названия')
-            return (audio_url, title)
+    def _process_playlist(self, entries: List[dict]) -> List[dict]:
+        """Обработка плейлиста: только id и названия, потоки извлекаются позже"""
+        if not entries:
+            raise YouTubeAccessError("Плейлист пуст или недоступен")
 
-        except Exception as e:
-            logger.warning(f"Ошибка обработки видео {url}: {str(e)}")
-            return None
+        results = compact_playlist_entries(entries)
+        if not results:
+            raise YouTubeAccessError("В плейлисте нет доступных треков")
+        return results
 
-    async def _process_video(self, info: dict, ydl_opts: dict) -> Tuple[str, str]:
+    async def _process_video(self, info: dict, ydl_opts: dict, target_bitrate: Optional[int] = None) -> Track:
         """Обработка одиночного видео"""
         if info.get('is_live'):
             raise YouTubeAccessError("Лайв-стримы не поддерживаются")
@@ -1752,21 +4769,246 @@ class YouTubeClient:
         if info.get('duration', 0) > 7200:
             raise YouTubeAccessError("Видео слишком длинное (максимум 2 часа)")
 
-        audio_url = get_best_audio_format(info.get('formats', []))
+        audio_url = select_audio_format(info.get('formats', []), target_bitrate)
         if not audio_url:
             raise YouTubeAccessError("Не найдены аудио форматы")
 
         title = info.get('title', 'Без названия')
-        return (audio_url, title)
+        return Track(audio_url, title, info.get('duration') or 0, info.get('id'))
 
 # Создаем глобальный экземпляр клиента
 youtube_client = YouTubeClient()
 
+class Setting(NamedTuple):
+    """Описание параметра, который можно менять без перезапуска"""
+    type: type
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+    choices: Optional[Tuple[str, ...]] = None
+    check: Optional[Callable[[Any], bool]] = None
+    apply: Optional[Callable[[], None]] = None  # Перестройка объектов, созданных из параметра
+
+def resize_guild_queues():
+    for state in guild_states.values():
+        state.queue.maxlen = MAX_QUEUE_SIZE
+        state.playlist_queue.maxlen = MAX_PLAYLIST_SIZE
+        state._page_cache.clear()
+
+def resize_pools():
+    youtube_client.executor.resize(EXTRACT_WORKERS, EXTRACT_WORKERS - EXTRACT_INTERACTIVE_RESERVE)
+    youtube_client.executor.set_limits(EXTRACT_GUILD_INFLIGHT, parse_guild_weights(EXTRACT_GUILD_WEIGHTS))
+    spawn_pool.resize(SPAWN_WORKERS)
+    disk_pool.resize(DISK_WORKERS)
+
+def resize_caches():
+    audio_cache.resize(AUDIO_CACHE_SIZE, AUDIO_CACHE_TTL)
+    opus_cache.max_bytes = OPUS_CACHE_MAX_MB * 2**20
+    disk_pool.submit(opus_cache.evict, opus_cache.max_bytes)
+
+def resize_limiters():
+    now_playing_updater._limiter.limit = NOW_PLAYING_CHANNEL_EDITS
+    now_playing_updater._limiter.period = NOW_PLAYING_CHANNEL_PERIOD
+
+def update_ydl_options():
+    YDL_OPTIONS['socket_timeout'] = YDL_SOCKET_TIMEOUT
+    YDL_OPTIONS['retries'] = YDL_RETRIES
+
+def apply_log_level():
+    logging.getLogger().setLevel(LOG_LEVEL)
+
+def is_ffmpeg_options(value: dict) -> bool:
+    return set(value) == {'before_options', 'options'} and all(isinstance(v, str) for v in value.values())
+
+# Имя параметра совпадает с глобальной константой и переменной окружения
+SETTINGS_SPEC: Dict[str, Setting] = {
+    'MAX_QUEUE_SIZE': Setting(int, 1, 10000, apply=resize_guild_queues),
+    'MAX_PLAYLIST_SIZE': Setting(int, 1, 100000, apply=resize_guild_queues),
+    'PLAYLIST_PREFETCH_WINDOW': Setting(int, 0, 20),
+    'PLAY_TIMEOUT': Setting(int, 30, 24 * 3600),
+    'FFMPEG_OPTIONS': Setting(dict, check=is_ffmpeg_options),
+    'YDL_SOCKET_TIMEOUT': Setting(int, 1, 300, apply=update_ydl_options),
+    'YDL_RETRIES': Setting(int, 0, 50, apply=update_ydl_options),
+    'HEDGE_DEFAULT_DELAY': Setting(float, 0.1, 60),
+    'EXTRACT_WORKERS': Setting(int, 1, 64, apply=resize_pools),
+    'EXTRACT_INTERACTIVE_RESERVE': Setting(int, 0, 63, apply=resize_pools),
+    'EXTRACT_GUILD_INFLIGHT': Setting(int, 1, 64, apply=resize_pools),
+    'EXTRACT_GUILD_WEIGHTS': Setting(dict, check=is_guild_weights, apply=resize_pools),
+    'SPAWN_WORKERS': Setting(int, 1, 16, apply=resize_pools),
+    'DISK_WORKERS': Setting(int, 1, 16, apply=resize_pools),
+    'AUDIO_CACHE_SIZE': Setting(int, 1, 100000, apply=resize_caches),
+    'AUDIO_CACHE_TTL': Setting(int, 0, 7 * 24 * 3600, apply=resize_caches),
+    'OPUS_CACHE_MAX_MB': Setting(int, 0, 1024 * 1024, apply=resize_caches),
+    'NOW_PLAYING_INTERVAL': Setting(float, 1, 600),
+    'NOW_PLAYING_CHANNEL_EDITS': Setting(int, 1, 50, apply=resize_limiters),
+    'NOW_PLAYING_CHANNEL_PERIOD': Setting(float, 0.5, 600, apply=resize_limiters),
+    'LOOP_LAG_THRESHOLD': Setting(float, 0.01, 60),
+    'DISK_CHECK_INTERVAL': Setting(int, 5, 3600),
+    'DISK_LOW_GB': Setting(float, 0, 1000),
+    'DISK_CRITICAL_GB': Setting(float, 0, 1000),
+    'LOG_LEVEL': Setting(str, choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'), apply=apply_log_level),
+}
+
+class RuntimeSettings:
+    """Типизированные настройки из файла и переменных окружения с горячей перезагрузкой.
+
+    Код читает глобальные константы в момент использования, поэтому новое
+    значение просто подставляется в модуль; пулы, кэши и ограничители,
+    созданные из констант, перестраиваются функциями apply. Переменные
+    окружения важнее файла, а параметр, удаленный из файла, возвращается
+    к значению при запуске.
+    """
+    def __init__(self, path: str, spec: Dict[str, Setting]):
+        self.path = path
+        self.spec = spec
+        self.defaults = {name: globals()[name] for name in spec}
+        self.loaded_at: Optional[float] = None
+        self._reload_task: Optional[asyncio.Task] = None
+        self._reload_again = False
+
+    def _parse(self, name: str, raw: Any) -> Any:
+        setting = self.spec[name]
+        if setting.type is dict and isinstance(raw, str):
+            raw = json.loads(raw)
+        if setting.type is float and isinstance(raw, (int, float)) and not isinstance(raw, bool):
+            value = float(raw)
+        elif setting.type is int and isinstance(raw, str):
+            value = int(raw)
+        elif setting.type is float and isinstance(raw, str):
+            value = float(raw)
+        elif isinstance(raw, setting.type) and not isinstance(raw, bool):
+            value = raw
+        else:
+            raise ValueError(f"ожидается {setting.type.__name__}")
+
+        if setting.type is str:
+            value = value.upper()
+        if setting.minimum is not None and value < setting.minimum:
+            raise ValueError(f"меньше {setting.minimum}")
+        if setting.maximum is not None and value > setting.maximum:
+            raise ValueError(f"больше {setting.maximum}")
+        if setting.choices and value not in setting.choices:
+            raise ValueError(f"допустимо: {', '.join(setting.choices)}")
+        if setting.check and not setting.check(value):
+            raise ValueError("недопустимое значение")
+        return value
+
+    def read(self) -> Tuple[Dict[str, Any], List[str]]:
+        """Читает и проверяет файл и окружение (в потоке); при ошибках ничего не применяется"""
+        values, errors = dict(self.defaults), []
+        sources = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("ожидается JSON-объект")
+            sources.append(('файл', data))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            errors.append(f"{self.path}: {e}")
+        sources.append(('окружение', {name: os.environ[name] for name in self.spec if name in os.environ}))
+
+        for source, data in sources:
+            for name, raw in data.items():
+                if name not in self.spec:
+                    errors.append(f"{name} ({source}): неизвестный параметр")
+                    continue
+                try:
+                    values[name] = self._parse(name, raw)
+                except Exception as e:
+                    errors.append(f"{name} ({source}): {e}")
+
+        if values['EXTRACT_INTERACTIVE_RESERVE'] >= values['EXTRACT_WORKERS']:
+            errors.append("EXTRACT_INTERACTIVE_RESERVE должен быть меньше EXTRACT_WORKERS")
+        if values['DISK_CRITICAL_GB'] > values['DISK_LOW_GB']:
+            errors.append("DISK_CRITICAL_GB не может быть больше DISK_LOW_GB")
+        return values, errors
+
+    def apply(self, values: Dict[str, Any]) -> Tuple[Dict[str, Tuple[Any, Any]], List[str]]:
+        """Подставляет изменившиеся значения и перестраивает зависящие от них объекты.
+
+        Если функция перестройки упала, ее параметры возвращаются к прежним
+        значениям, а она вызывается еще раз, чтобы объекты снова им соответствовали.
+        """
+        changes = {}
+        hooks: Dict[Callable[[], None], List[str]] = {}
+        for name, value in values.items():
+            old = globals()[name]
+            if old == value:
+                continue
+            globals()[name] = value
+            changes[name] = (old, value)
+            hook = self.spec[name].apply
+            if hook:
+                hooks.setdefault(hook, []).append(name)
+
+        errors = []
+        for hook, names in hooks.items():
+            try:
+                hook()
+            except Exception as e:
+                errors.append(f"{', '.join(names)}: {e}")
+                logger.error(f"Ошибка применения настроек ({hook.__name__}), откатываем {', '.join(names)}: {e}")
+                for name in names:
+                    globals()[name] = changes.pop(name)[0]
+                try:
+                    hook()
+                except Exception as e:
+                    logger.error(f"Не удалось вернуть прежние настройки ({hook.__name__}): {e}")
+        self.loaded_at = time.time()
+        return changes, errors
+
+    def load(self) -> List[str]:
+        """Синхронная загрузка при запуске"""
+        values, errors = self.read()
+        if errors:
+            for error in errors:
+                logger.error(f"Ошибка настроек: {error}")
+            return errors
+        changes, errors = self.apply(values)
+        return errors
+
+    async def reload(self) -> Tuple[Dict[str, Tuple[Any, Any]], List[str]]:
+        values, errors = await disk_pool.run(self.read)
+        if errors:
+            logger.error(f"Настройки не применены: {'; '.join(errors)}")
+            return {}, errors
+        changes, errors = self.apply(values)
+        for name, (old, new) in changes.items():
+            logger.info(f"Настройка {name}: {old} -> {new}")
+        return changes, errors
+
+    def schedule_reload(self):
+        """Перезагрузка по сигналу: задача хранится до завершения, сигналы во время нее не теряются"""
+        if self._reload_task and not self._reload_task.done():
+            self._reload_again = True
+            return
+        self._reload_task = asyncio.create_task(self._reload_signalled())
+        self._reload_task.add_done_callback(self._reload_done)
+
+    async def _reload_signalled(self):
+        while True:
+            self._reload_again = False
+            await self.reload()
+            if not self._reload_again:
+                return
+
+    @staticmethod
+    def _reload_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Ошибка перезагрузки настроек по сигналу: {task.exception()}")
+
+runtime_settings = RuntimeSettings(SETTINGS_FILE, SETTINGS_SPEC)
+
 if __name__ == "__main__":
     try:
         check_cookies()
         check_disk_space()  # Проверяем место перед запуском
         logger.info("Запуск бота с валидными cookies...")
+        runtime_settings.load()
+        startup_timer.mark("загрузка модуля")
+        if USE_UVLOOP:
+            install_uvloop()
         
         # Создаем и запускаем бота
         bot.run(os.getenv("DISCORD_TOKEN"))
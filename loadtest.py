@@ -0,0 +1,350 @@
+"""Нагрузочный стенд: много серверов в одном процессе без Discord и YouTube.
+
+Команды бота (play_slash, skip_slash, queue_slash) и handle_song_complete
+вызываются напрямую с поддельными Interaction и VoiceClient. Поддельный
+голосовой клиент читает кадры в своем потоке каждые 20 мс, как плеер
+discord.py, и считает пропущенные дедлайны. Вместо YouTubeClient работает
+заглушка с искусственной задержкой.
+
+Пример:
+    python loadtest.py --guilds 1,10,50,100 --duration 60
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('OPUS_CACHE_MAX_MB', '0')  # Поддельные треки не проходят через ffmpeg
+
+import discord
+
+import bot as music_bot
+
+FRAME_SIZE = 3840  # 20 мс PCM 48 кГц стерео 16 бит
+FRAME_MISS_TOLERANCE = 0.005  # Опоздание кадра больше 5 мс считается пропуском
+LAG_SAMPLE_INTERVAL = 0.05
+
+# Общая статистика прогона
+frame_misses = 0
+frames_sent = 0
+stats_lock = threading.Lock()
+command_latency: Dict[str, List[float]] = defaultdict(list)
+loop_lag: List[float] = []
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, channel, content=None):
+        self.id = next(self._ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        if content is not None:
+            self.content = content
+        return self
+
+class FakeTextChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        return FakeMessage(self, content)
+
+class FakeAudio(discord.AudioSource):
+    """Замена FFmpegAudio: отдает тишину длительностью из stub:// ссылки"""
+    def __init__(self, url: str, **kwargs):
+        self.total_frames = int(float(url.rsplit('d=', 1)[-1]) / music_bot.FRAME_DURATION)
+        self.frames_read = 0
+
+    @property
+    def position(self) -> float:
+        return self.frames_read * music_bot.FRAME_DURATION
+
+    def read(self) -> bytes:
+        if self.frames_read >= self.total_frames:
+            return b''
+        self.frames_read += 1
+        return b'\0' * FRAME_SIZE
+
+class FakeVoiceClient:
+    """Голосовой клиент, который читает кадры в отдельном потоке по 20 мс часам"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self._connected = True
+        self._paused = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return bool(self._thread and self._thread.is_alive()) and not self._paused.is_set()
+
+    def is_paused(self) -> bool:
+        return bool(self._thread and self._thread.is_alive()) and self._paused.is_set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+        self._connected = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    def play(self, source, after=None):
+        self.source = source
+        self._stop = threading.Event()
+        self._paused.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop_event):
+        global frame_misses, frames_sent
+        next_deadline = time.perf_counter()
+        error = None
+        try:
+            while not stop_event.is_set():
+                if self._paused.is_set():
+                    time.sleep(music_bot.FRAME_DURATION)
+                    next_deadline = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                with stats_lock:
+                    frames_sent += 1
+                    if now - next_deadline > FRAME_MISS_TOLERANCE:
+                        frame_misses += 1
+                next_deadline += music_bot.FRAME_DURATION
+                delay = next_deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_deadline = time.perf_counter()
+        except Exception as e:
+            error = e
+        if after:
+            after(error)
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id: int, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.bitrate = 64000
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(0.05)
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+class FakeMember:
+    def __init__(self, user_id: int, channel):
+        self.id = user_id
+        self.voice = type('VoiceState', (), {'channel': channel})()
+        self.guild_permissions = discord.Permissions.all()
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.voice_client = None
+        self.member = FakeMember(guild_id * 10, FakeVoiceChannel(guild_id * 100, self))
+
+    def get_member(self, user_id: int):
+        return self.member
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        self._done = True
+        self._interaction.message = FakeMessage(self._interaction.channel, content)
+
+    async def edit_message(self, **kwargs):
+        await asyncio.sleep(0)
+        self._done = True
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self._channel = channel
+
+    async def send(self, content=None, **kwargs):
+        return await self._channel.send(content, **kwargs)
+
+class FakeInteraction:
+    """Минимальный discord.Interaction для вызова команд бота"""
+    def __init__(self, guild: FakeGuild, channel: FakeTextChannel):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = channel
+        self.user = guild.member
+        self.message = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(channel)
+
+    @property
+    def __class__(self):
+        # play_next и handle_song_complete проверяют isinstance(ctx, discord.Interaction)
+        return discord.Interaction
+
+    async def edit_original_response(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        if self.message:
+            self.message.content = content
+
+    async def original_response(self):
+        return self.message
+
+class StubYouTubeClient:
+    """Заглушка YouTubeClient: имитирует задержку извлечения без сети"""
+    def __init__(self, latency: float, track_seconds: float):
+        self.latency = latency
+        self.track_seconds = track_seconds
+        self.executor = music_bot.youtube_client.executor
+        self._counter = itertools.count(1)
+
+    async def extract_info(self, url: str, process_playlist: bool = False, target_bitrate: Optional[int] = None,
+                           guild_id: Optional[int] = None):
+        await asyncio.sleep(random.expovariate(1 / self.latency))
+        n = next(self._counter)
+        return music_bot.Track(
+            f"stub://{n}?d={self.track_seconds}",
+            f"Тестовый трек {n}",
+            self.track_seconds,
+            f"stub{n:06d}"
+        )
+
+    async def close(self):
+        pass
+
+async def timed(name: str, coro):
+    started = time.perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        music_bot.logger.warning(f"Команда {name} завершилась ошибкой: {e}")
+    command_latency[name].append(time.perf_counter() - started)
+
+async def sample_loop_lag(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + LAG_SAMPLE_INTERVAL
+        await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+        loop_lag.append(max(0.0, loop.time() - expected))
+
+async def simulate_guild(guild_id: int, stop: asyncio.Event, command_interval: float):
+    """Сценарий одного сервера: несколько /play, затем /queue и /skip вперемешку"""
+    guild = FakeGuild(guild_id)
+    channel = FakeTextChannel(guild_id * 1000)
+
+    def interaction():
+        return FakeInteraction(guild, channel)
+
+    for n in range(3):
+        await timed('play', music_bot.play_slash.callback(interaction(), query=f"track {guild_id}-{n}"))
+
+    while not stop.is_set():
+        await asyncio.sleep(random.expovariate(1 / command_interval))
+        action = random.random()
+        if action < 0.5:
+            await timed('queue', music_bot.queue_slash.callback(interaction()))
+        elif action < 0.8:
+            await timed('play', music_bot.play_slash.callback(interaction(), query=f"track {guild_id}"))
+        else:
+            await timed('skip', music_bot.skip_slash.callback(interaction()))
+
+async def run_stage(guild_count: int, duration: float, command_interval: float) -> dict:
+    global frame_misses, frames_sent, loop_lag
+    with stats_lock:
+        frame_misses = frames_sent = 0
+    command_latency.clear()
+    loop_lag = []
+    music_bot.guild_states.clear()
+
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(sample_loop_lag(stop))]
+    tasks += [
+        asyncio.create_task(simulate_guild(guild_id, stop, command_interval))
+        for guild_id in range(1, guild_count + 1)
+    ]
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.wait(tasks, timeout=command_interval * 2)
+    for task in tasks:
+        task.cancel()
+
+    for state in music_bot.guild_states.values():
+        if state.voice_client:
+            state.voice_client.stop()
+
+    return {
+        'guilds': guild_count,
+        'frames': frames_sent,
+        'misses': frame_misses,
+        'lag_p50': percentile(loop_lag, 0.5),
+        'lag_p99': percentile(loop_lag, 0.99),
+        'lag_max': max(loop_lag, default=0.0),
+        'commands': {name: (percentile(v, 0.5), percentile(v, 0.99), len(v)) for name, v in command_latency.items()}
+    }
+
+def print_stage(result: dict):
+    miss_rate = result['misses'] / result['frames'] * 100 if result['frames'] else 0.0
+    print(f"\n=== Серверов: {result['guilds']} ===")
+    print(f"Кадров: {result['frames']}, пропущено дедлайнов: {result['misses']} ({miss_rate:.2f}%)")
+    print(f"Задержка цикла: p50 {result['lag_p50'] * 1000:.1f} мс, p99 {result['lag_p99'] * 1000:.1f} мс, max {result['lag_max'] * 1000:.1f} мс")
+    for name, (p50, p99, count) in sorted(result['commands'].items()):
+        print(f"/{name}: {count} вызовов, p50 {p50 * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс")
+
+async def main(args):
+    music_bot.FFmpegAudio = FakeAudio
+    music_bot.youtube_client = StubYouTubeClient(args.extract_latency, args.track_seconds)
+    music_bot.now_playing_updater.start()
+
+    for guild_count in args.guilds:
+        print_stage(await run_stage(guild_count, args.duration, args.command_interval))
+
+    await music_bot.now_playing_updater.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд музыкального бота")
+    parser.add_argument('--guilds', type=lambda s: [int(x) for x in s.split(',')], default=[1, 10, 50],
+                        help="Количество серверов на каждом этапе, через запятую")
+    parser.add_argument('--duration', type=float, default=30, help="Длительность этапа (секунды)")
+    parser.add_argument('--track-seconds', type=float, default=20, help="Длительность тестового трека")
+    parser.add_argument('--extract-latency', type=float, default=0.5, help="Средняя задержка заглушки извлечения")
+    parser.add_argument('--command-interval', type=float, default=5, help="Средний интервал между командами сервера")
+    asyncio.run(main(parser.parse_args()))
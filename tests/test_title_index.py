@@ -0,0 +1,37 @@
+"""Загрузка индекса названий дает тот же индекс, что и поштучное добавление."""
+import os
+import random
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import bot as music_bot
+
+WORDS = ["lofi", "beats", "night", "drive", "rain", "piano", "remix", "live",
+         "ночь", "дождь", "город", "мечта", "Official", "Video", "feat.", "Mix"]
+
+
+def build_incremental(path, count):
+    random.seed(37)
+    index = music_bot.TitleIndex(path)
+    for i in range(count):
+        title = " ".join(random.choices(WORDS, k=random.randint(1, 9))) + f" {i % (count // 2)}"
+        track = music_bot.Track(url=f"https://youtu.be/vid{i:07d}", title=title, video_id=f"vid{i:07d}")
+        for _ in range(random.randint(1, 3)):
+            index.record(random.randint(1, 5), track)
+    return index
+
+
+def test_load_matches_incremental(tmp_path):
+    path = str(tmp_path / "title_index.json")
+    built = build_incremental(path, 20000)
+    built.save()
+
+    loaded = music_bot.TitleIndex(path)
+
+    assert loaded._keys == built._keys
+    assert loaded._titles == built._titles
+    assert loaded._global == built._global
+    assert loaded._per_guild == built._per_guild
+    for prefix in ("lofi", "ночь го", "mix 1", "feat", "d"):
+        for guild_id in (1, 3, 6):
+            assert loaded.search(guild_id, prefix) == built.search(guild_id, prefix)